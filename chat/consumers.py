@@ -1,13 +1,19 @@
+import asyncio
 import json
 import time
-from typing import Callable, Any
+import uuid
+from collections import Counter
 
 import aio_pika
 from aio_pika.abc import AbstractIncomingMessage
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.http import QueryDict
 
 from utils.ack_manager import AckManager
+from utils.contacts import ContactState
 from utils.data import (
+    ContactsDelta,
     MessageType,
     TargetType,
     Message,
@@ -16,6 +22,7 @@ from utils.data import (
     GroupData,
     FriendType,
     Ack,
+    BatchAck,
 )
 from utils.db_fun import (
     db_query_group_info,
@@ -28,7 +35,9 @@ from utils.db_fun import (
     db_friendship_change,
     db_create_multimedia,
     db_query_group,
-    db_add_read_message,
+    db_query_group_state,
+    db_touch_device,
+    db_read_messages,
     db_reduce_person,
     db_change_group_owner,
     db_add_or_remove_admin,
@@ -46,37 +55,74 @@ from utils.db_fun import (
     db_check_friend_if_deleted,
     db_check_friend_if_blocked,
 )
+from utils.codec import (
+    JsonCodec,
+    codec_for_subprotocols,
+    broker_codec,
+    encode_body,
+    BrokerMessage,
+)
+from utils.handlers import HandlerRegistry
+from utils.idempotency import globalIdempotencyStore
+from utils.membership import globalMembershipCache
+from utils.outbound import OutboundBuffer
+from utils.presence import globalPresenceRegistry
+from utils.rabbitmq import device_queue_arguments, globalRabbitMQPool
+from utils.read_receipts import ReadReceiptBuffer
 from utils.uid import globalMessageIdMaker
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # handlers of messages from the websocket (rcv_*) and from rabbitmq (cb_*)
+    rcv = HandlerRegistry("rcv")
+    cb = HandlerRegistry("cb")
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.retry = 5
         self.timeout = 5
+        self.fanout_concurrency = settings.CHAT_FANOUT_CONCURRENCY
         self.user_id = None
-        self.rabbitmq_connection = None
+        self.device_id = uuid.uuid4().hex  # identifies this socket in the presence registry
+        self.heartbeat: asyncio.Task | None = None  # keeps this socket online in the registry
         self.self_exchange = None
-        self.friend_list: list[int] = []
-        self.group_list: list[int] = []
-        self.group_members: dict[int, list[int]] = {}
-        self.group_names = None
-        self.group_owner: list[int] = []
-        self.group_admin: dict[int, list[int]] = {}
+        self.queue: aio_pika.abc.AbstractQueue | None = None  # this browser's queue
+        self.consumer_tag: str | None = None  # None while consuming is paused
+        self.flow_lock = asyncio.Lock()
+        # friends and groups, checked on every message
+        self.contacts = ContactState(globalMembershipCache)
         self.channel: aio_pika.Channel | None = None
         self.storage_exchange = None
         self.ack_manager = AckManager()
-        self.received = {}
+        self.outbound: OutboundBuffer | None = None  # set if the client asked for batched frames
+        self.read_receipts = ReadReceiptBuffer(
+            self.send_read_receipts,
+            settings.CHAT_READ_RECEIPT_DELAY,
+            settings.CHAT_READ_RECEIPT_MAX_ITEMS,
+        )
+        self.codec = JsonCodec  # websocket codec, negotiated through Sec-WebSocket-Protocol
 
     async def connect(self):
         # websocket connect
-        await self.accept()
+        self.codec = codec_for_subprotocols(self.scope.get("subprotocols", []))
+        await self.accept(subprotocol=self.codec.subprotocol)
         # get user id
         self.user_id = self.scope["user_id"]
         print("user id we get in connect is: ", self.user_id)
-        # rabbitmq connect
-        self.rabbitmq_connection = await aio_pika.connect_robust("amqp://localhost")
-        self.channel = await self.rabbitmq_connection.channel()
+        await globalPresenceRegistry.add(self.user_id, self.device_id)
+        self.heartbeat = asyncio.create_task(self.presence_heartbeat())
+        # clients passing batch=1 receive pushed messages coalesced into array frames
+        query_params = QueryDict(self.scope["query_string"].decode("utf-8"))
+        if query_params.get("batch") == "1":
+            self.outbound = OutboundBuffer(
+                self._send_raw,
+                self.codec.encode_batch,
+                settings.CHAT_COALESCE_DELAY,
+                settings.CHAT_COALESCE_MAX_ITEMS,
+            )
+        # borrow a channel from the process wide rabbitmq pool
+        self.channel = await globalRabbitMQPool.acquire_channel()
+        await self.watch_group_changes()
         # start consuming
         print("connected!")
         await self.start_consuming()
@@ -90,9 +136,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # get user id
         self.user_id = user_id
         print("user id we get in connect is: ", self.user_id)
-        # rabbitmq connect
-        self.rabbitmq_connection = await aio_pika.connect_robust("amqp://localhost")
-        self.channel = await self.rabbitmq_connection.channel()
+        # borrow a channel from the process wide rabbitmq pool
+        self.channel = await globalRabbitMQPool.acquire_channel()
         # start consuming
         print("connected!")
         await self.pseudo_start_consuming(user_id)
@@ -105,7 +150,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             type="fanout",
         )
         # get friend list
-        self.friend_list = await db_query_friends(self.user_id)
+        self.contacts.set_friends(await db_query_friends(self.user_id))
         # get group list
         await self.fresh_group_info()
         # build queue and bind to exchange to receive message from rabbitmq server
@@ -123,24 +168,72 @@ class ChatConsumer(AsyncWebsocketConsumer):
             type="fanout",
         )
         # get friend list
-        self.friend_list = await db_query_friends(self.user_id)
+        self.contacts.set_friends(await db_query_friends(self.user_id))
         # get group list
         await self.fresh_group_info()
         # build queue and bind to exchange to receive message from rabbitmq server
         queue_name_receive = self.scope["session"]["browser"]
-        queue_receive = await self.channel.declare_queue(queue_name_receive)
+        queue_receive = await self.declare_device_queue(queue_name_receive)
         await queue_receive.bind(self.self_exchange)
+        await db_touch_device(queue_name_receive, self.user_id)
+        # a stalled client holds at most CHAT_PREFETCH deliveries
+        await self.channel.set_qos(prefetch_count=settings.CHAT_PREFETCH)
         # start consuming
-        await queue_receive.consume(self.callback)
+        self.queue = queue_receive
+        self.consumer_tag = await queue_receive.consume(self.callback)
+
+    async def declare_device_queue(self, name: str) -> aio_pika.abc.AbstractQueue:
+        arguments = device_queue_arguments()
+        try:
+            return await self.channel.declare_queue(name, arguments=arguments)
+        except aio_pika.exceptions.ChannelPreconditionFailed:
+            # declared before these arguments existed, which cannot be changed in place;
+            # the broker closed the channel, so start over on a fresh one
+            await self.reopen_channel()
+        try:
+            # only an empty queue is replaced, deleting it must not drop waiting messages
+            await self.channel.queue_delete(name, if_empty=True)
+        except aio_pika.exceptions.ChannelPreconditionFailed:
+            # keep the old queue until a later connection has consumed its messages
+            print(f"queue {name} still holds messages, keeping its old arguments")
+            await self.reopen_channel()
+            return await self.channel.declare_queue(name, passive=True)
+        print(f"redeclaring queue {name}")
+        return await self.channel.declare_queue(name, arguments=arguments)
+
+    async def reopen_channel(self):
+        # a channel error closes the channel, replace it with a fresh one
+        await globalRabbitMQPool.release_channel(self.channel)
+        self.channel = await globalRabbitMQPool.acquire_channel()
 
     async def fresh_group_info(self):
-        (
-            self.group_list,
-            self.group_members,
-            self.group_names,
-            self.group_owner,
-            self.group_admin,
-        ) = await db_query_group(self.user_id)
+        self.contacts.set_groups(*await db_query_group(self.user_id))
+
+    async def watch_group_changes(self):
+        try:
+            await globalMembershipCache.start()
+        except Exception as e:
+            # deltas still keep the cache right, announcements only repair missed ones
+            print(f"cannot listen to group changes: {str(e)}")
+
+    async def group_changed(self, delta: ContactsDelta):
+        # apply a change made here and announce it to the other workers
+        self.contacts.apply_group(delta, self.user_id)
+        try:
+            await globalMembershipCache.announce(
+                self.channel, delta.group_id, None if delta.deleted else delta.version
+            )
+        except Exception as e:
+            print(f"cannot announce change of group {delta.group_id}: {str(e)}")
+
+    async def fresh_one_group(self, group_id: int, min_version: int = 0):
+        # every member reloading the same group shares one query
+        state = await db_query_group_state(group_id)
+        if state is not None and state[4] < min_version:
+            # the kept result predates the change we were told about
+            db_query_group_state.forget(group_id)
+            state = await db_query_group_state(group_id)
+        self.contacts.set_group(group_id, state, self.user_id)
 
     async def storage_start_consuming(self):
         # build storage exchange
@@ -151,20 +244,52 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await storage_queue.bind(self.storage_exchange)
 
+    async def presence_heartbeat(self):
+        # a device expires CHAT_PRESENCE_TTL seconds after its last refresh
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT)
+            await globalPresenceRegistry.add(self.user_id, self.device_id)
+
     async def disconnect(self, close_code):
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        if self.outbound is not None:
+            self.outbound.discard()  # the socket is gone, buffered frames are dropped
+        self.contacts.clear()  # release shared group entries
+        if self.user_id is not None:
+            await globalPresenceRegistry.remove(self.user_id, self.device_id)
+            try:
+                await db_touch_device(self.scope["session"]["browser"], self.user_id)
+            except Exception as e:
+                print(f"cannot record device: {str(e)}")
+        try:
+            await self.read_receipts.close()  # still needs the channel
+        except Exception as e:
+            print(f"cannot send read receipts: {str(e)}")
         try:
-            await self.rabbitmq_connection.close()
+            await globalRabbitMQPool.release_channel(self.channel)
         except Exception as e:
-            print(f"An error occurred while closing the RabbitMQ connection: {str(e)}")
+            print(f"An error occurred while releasing the RabbitMQ channel: {str(e)}")
+        self.channel = None
 
-    async def receive(self, text_data=None, _=None):
+    async def receive(self, text_data=None, bytes_data=None):
         # step 1. parse data
-        dict_data = json.loads(text_data)
+        dict_data = self.codec.loads(text_data if text_data is not None else bytes_data)
         print(dict_data)
         if "m_type" not in dict_data:
+            if "message_id" not in dict_data:
+                # received a batch ack message
+                batch_received = BatchAck.model_validate(dict_data)
+                await self.ack_manager.acknowledge_batch(
+                    batch_received.message_ids, batch_received.up_to, self.ack_multiple
+                )
+                await self.update_flow()
+                return
             # received an ack message
             ack_received = Ack.model_validate(dict_data)
             await self.ack_manager.acknowledge(ack_received.message_id)
+            await self.update_flow()
             return
         # received a normal message
         message_received = Message.model_validate(dict_data)
@@ -172,31 +297,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # override fields
         message_received.sender = self.user_id
         message_received.who_read = []
+        message_received.delta = None  # only the backend describes contact changes
         message_received.time = round(time.time() * 1000)
         message_received.t_type = (
             TargetType.GROUP
-            if message_received.receiver in self.group_list
+            if self.contacts.is_group(message_received.receiver)
             else TargetType.FRIEND
         )
 
         # step 2. give back ack
         tmp_id = message_received.message_id
         print("received tmp_id", tmp_id)
-        if tmp_id in self.received:
-            await self.send(
+        message_id = globalMessageIdMaker.get_id()
+        received_id = await globalIdempotencyStore.claim(
+            self.user_id, self.scope["session"]["browser"], tmp_id, message_id
+        )
+        if received_id is not None:
+            await self.send_frame(
+                self.codec.encode_model(
+                    Ack(
+                        message_id=received_id,
+                        reference=tmp_id,
+                    )
+                )
+            )
+            return
+        message_received.message_id = message_id
+        await self.send_frame(
+            self.codec.encode_model(
                 Ack(
-                    message_id=self.received[tmp_id].message_id,
+                    message_id=message_received.message_id,
                     reference=tmp_id,
-                ).model_dump_json()
+                )
             )
-            return
-        message_received.message_id = globalMessageIdMaker.get_id()
-        self.received[tmp_id] = message_received
-        await self.send(
-            Ack(
-                message_id=message_received.message_id,
-                reference=tmp_id,
-            ).model_dump_json()
         )
         # step2.5 check receiver availability
         if message_received.m_type < MessageType.FUNCTION:
@@ -215,53 +348,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     )
                     await self.send_message_to_target(message_new, str(self.user_id))
                     return
-            if message_received.receiver not in self.group_list + self.friend_list:
+            if message_received.receiver not in self.contacts:
                 return
 
 
         # step 3. publish message to persistent storage queue
         if message_received.m_type < MessageType.FUNCTION:
-            message_json = message_received.model_dump_json()
-            await self.storage_exchange.publish(
-                aio_pika.Message(
-                    body=message_json.encode(),  # turn message into bytes
-                ),
-                routing_key="",
-            )
-            print("send to storage: ", message_json)
+            await self.publish_to_storage(message_received)
+            print("send to storage: ", message_received.message_id)
 
         # step 4. handle message
         # to sync across same user's different devices
 
-        handler: Callable[[Message], Any] = {
-            MessageType.FUNC_CREATE_GROUP: self.rcv_create_group,
-            MessageType.FUNC_ADD_GROUP_MEMBER: self.rcv_add_group_member,
-            MessageType.FUNC_APPLY_FRIEND: self.rcv_apply_friend,
-            MessageType.FUNC_ACCEPT_FRIEND: self.rcv_accept_friend,
-            MessageType.FUNC_REJECT_FRIEND: self.rcv_reject_friend,
-            MessageType.FUNC_BlOCK_FRIEND: self.rcv_block_friend,
-            MessageType.FUNC_UNBLOCK_FRIEND: self.rcv_unblock_friend,
-            MessageType.FUNC_DEL_FRIEND: self.rcv_delete_friend,
-            MessageType.FUNC_SEND_META: self.rcv_send_meta_info,
-            MessageType.FUNC_READ_MESSAGE: self.rcv_read_message,
-            MessageType.FUNC_LEAVE_GROUP: self.rcv_leave_group,
-            MessageType.FUNC_CHANGE_GROUP_OWNER: self.rcv_change_group_owner,
-            MessageType.FUNC_ADD_GROUP_ADMIN: self.rcv_add_or_reduce_admin,
-            MessageType.FUNC_REMOVE_GROUP_ADMIN: self.rcv_add_or_reduce_admin,
-            MessageType.FUNC_REMOVE_GROUP_MEMBER: self.rcv_remove_group_member,
-            MessageType.FUNC_MESSAGE_ADD_BROADCAST: self.rcv_add_or_del_top_message,
-            MessageType.FUNC_MESSAGE_DEL_BROADCAST: self.rcv_add_or_del_top_message,
-            MessageType.FUNC_RECALL_MEMBER_MESSAGE: self.rcv_callback_member_message,
-            MessageType.FUNC_DELETE_MESSAGE: self.rcv_delete_message,
-            MessageType.FUNC_EDIT_MESSAGE: self.rcv_edit_message,
-            MessageType.FUNC_RECALL_SELF_MESSAGE: self.rcv_callback_self_message,
-            MessageType.FUNC_EDIT_PROFILE: self.rcv_edit_profile,
-            MessageType.FUNC_DELETE_GROUP: self.rcv_delete_group,
-            MessageType.FUNC_CHANGE_GROUP_NAME: self.rcv_change_group_name,
-            MessageType.FUNC_REJECT_CANDIDATE: self.rcv_reject_candidate,
-        }.get(message_received.m_type, self.rcv_handle_common_message)
-        await handler(message_received)
+        await self.rcv.dispatch(self, message_received.m_type, message_received)
 
+    @rcv.on(MessageType.FUNC_CREATE_GROUP)
     async def rcv_create_group(self, message: Message):
         if not isinstance(message.content.members, list):
             message.content = "Wrong format"
@@ -281,11 +382,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
         group_name = message.content.name
         group_members = message.content.members
         group_list, group_id = await db_build_group(
-            self.friend_list, self.user_id, group_name, group_members
+            self.contacts.friends, self.user_id, group_name, group_members
         )
+        await globalRabbitMQPool.sync_group(self.channel, group_id)
         message.content = group_id
-        for member in group_list:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(
+            group_id=group_id,
+            version=0,
+            snapshot=True,
+            name=group_name,
+            owner=self.user_id,
+            added_members=group_list,
+        )
+        self.contacts.apply_group(message.delta, self.user_id)
+        await self.send_message_to_targets(message, group_list)
         message_new = Message(
             message_id=globalMessageIdMaker.get_id(),
             m_type=MessageType.TEXT,
@@ -296,16 +406,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             time=int(time.time() * 1000),
             who_read=[],
         )
-        message_json = message_new.model_dump_json()
-        await self.storage_exchange.publish(
-            aio_pika.Message(
-                body=message_json.encode(),  # turn message into bytes
-            ),
-            routing_key="",
-        )
-        for member in group_list:
-            await self.send_message_to_target(message_new, str(member))
+        await self.publish_to_storage(message_new)
+        await self.send_message_to_targets(message_new, group_list)
 
+    @rcv.on(MessageType.FUNC_ADD_GROUP_MEMBER)
     async def rcv_add_group_member(self, message: Message):
         if not isinstance(message.content, list):
             message.content = "Wrong format"
@@ -320,15 +424,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
         group_id = message.receiver
         group_add_members = message.content
         try:
-            real_add_list, candidate_add_list, group_inform_list = await db_add_member(
-                group_id, group_add_members, self.user_id
-            )
+            (
+                real_add_list,
+                candidate_add_list,
+                group_inform_list,
+                version,
+            ) = await db_add_member(group_id, group_add_members, self.user_id)
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return None
         if len(real_add_list) > 0:  # if real add, send message to all group members
+            await globalRabbitMQPool.bind_group_members(
+                self.channel, group_id, real_add_list
+            )
             message.content = real_add_list
             message_new = Message(
                 message_id=globalMessageIdMaker.get_id(),
@@ -340,20 +450,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 time=int(time.time() * 1000),
                 who_read=[],
             )
-            message_json = message_new.model_dump_json()
-            await self.storage_exchange.publish(
-                aio_pika.Message(
-                    body=message_json.encode(),  # turn message into bytes
-                ),
-                routing_key="",
-            )
-            for member in group_inform_list:
-                await self.send_message_to_target(message_new, str(member))
+            await self.publish_to_storage(message_new)
+            await self.send_message_to_targets(message_new, group_inform_list)
         else:  # if not real add, send message to owner and admin
             message.content = candidate_add_list
-        for member in group_inform_list:
-            await self.send_message_to_target(message, str(member))
+        # candidates are not members, then the version is unchanged and the delta a no-op
+        message.delta = ContactsDelta(
+            group_id=group_id, version=version, added_members=real_add_list
+        )
+        await self.group_changed(message.delta)
+        await self.send_message_to_targets(message, group_inform_list)
 
+    @rcv.on(MessageType.FUNC_REJECT_CANDIDATE)
     async def rcv_reject_candidate(self, message: Message):
         group_id = message.receiver
         rejected_member = message.content
@@ -366,9 +474,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return None
-        for member in group_inform_list:
-            await self.send_message_to_target(message, str(member))
+        await self.send_message_to_targets(message, group_inform_list)
 
+    @rcv.on(MessageType.FUNC_APPLY_FRIEND)
     async def rcv_apply_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
@@ -384,17 +492,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.send_message_to_target(message, str(self.user_id))
         await self.send_message_to_target(message, str(friend_id))
 
+    @rcv.on(MessageType.FUNC_ACCEPT_FRIEND)
     async def rcv_accept_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
         friendship_now, message.content = await db_friendship(self.user_id, friend_id)
+        message.delta = ContactsDelta()  # unchanged unless the request succeeds
         if friendship_now == FriendType.already_receive_apply:
             message.content = "Success"
+            message.delta = ContactsDelta(
+                friends=[self.user_id, friend_id], friendship=1
+            )
+            self.contacts.apply_friends(message.delta, self.user_id)
             await self.send_message_to_target(message, str(friend_id))
             await db_friendship_change(self.user_id, friend_id, 1)
         await self.send_message_to_target(message, str(self.user_id))
         await self.send_message_to_target(message, str(friend_id))
 
+    @rcv.on(MessageType.FUNC_REJECT_FRIEND)
     async def rcv_reject_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
@@ -405,6 +520,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await db_friendship_change(self.user_id, friend_id, 3)
         await self.send_message_to_target(message, str(self.user_id))
 
+    @rcv.on(MessageType.FUNC_BlOCK_FRIEND)
     async def rcv_block_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
@@ -414,84 +530,116 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_message_to_front(message)
             return
         friendship_now, message.content = await db_friendship(self.user_id, friend_id)
+        message.delta = ContactsDelta()  # unchanged unless the request succeeds
         if friendship_now == FriendType.already_friend:
             message.content = "Success"
+            message.delta = ContactsDelta(
+                friends=[self.user_id, friend_id], friendship=2
+            )
+            self.contacts.apply_friends(message.delta, self.user_id)
             await self.send_message_to_target(message, str(friend_id))
             await db_friendship_change(self.user_id, friend_id, 2)
         await self.send_message_to_target(message, str(self.user_id))
         await self.send_message_to_target(message, str(friend_id))
 
+    @rcv.on(MessageType.FUNC_UNBLOCK_FRIEND)
     async def rcv_unblock_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
         friendship_now, message.content = await db_friendship(self.user_id, friend_id)
+        message.delta = ContactsDelta()  # unchanged unless the request succeeds
         if friendship_now == FriendType.already_block_friend:
             message.content = "Success"
+            message.delta = ContactsDelta(
+                friends=[self.user_id, friend_id], friendship=1
+            )
+            self.contacts.apply_friends(message.delta, self.user_id)
             await self.send_message_to_target(message, str(friend_id))
             await db_friendship_change(self.user_id, friend_id, 1)
         await self.send_message_to_target(message, str(self.user_id))
         await self.send_message_to_target(message, str(friend_id))
 
+    @rcv.on(MessageType.FUNC_DEL_FRIEND)
     async def rcv_delete_friend(self, message: Message):
         friend_id = message.receiver
         message.sender = self.user_id
         friendship_now, message.content = await db_friendship(self.user_id, friend_id)
+        message.delta = ContactsDelta()  # unchanged unless the request succeeds
         if friendship_now == FriendType.already_friend:
             message.content = "Success delete"
+            message.delta = ContactsDelta(
+                friends=[self.user_id, friend_id], friendship=3
+            )
+            self.contacts.apply_friends(message.delta, self.user_id)
             await self.send_message_to_target(message, str(friend_id))
             await db_friendship_change(self.user_id, friend_id, 3)
         await self.send_message_to_target(message, str(self.user_id))
 
     async def rcv_send_init_id(self, _: Message = None):
         contacts_info: list[int] = await db_query_fri_and_gro_id(self.user_id)
-        await self.send(text_data=json.dumps(contacts_info))
+        await self.send_frame(self.codec.dumps(contacts_info))
 
+    @rcv.on(MessageType.FUNC_SEND_META)
     async def rcv_send_meta_info(self, _: Message = None):
-        group_info: dict[int, GroupData] = await db_query_group_info(self.group_list)
+        group_info: dict[int, GroupData] = await db_query_group_info(self.contacts.groups)
         friends_id = await db_query_friends(self.user_id,if_include_block=True)
-        self.friend_list = await db_query_friends(self.user_id) # update friend list
+        self.contacts.set_friends(await db_query_friends(self.user_id))  # update friend list
         friend_info: dict[int, UserData] = await db_query_friends_info(friends_id)
         contacts_info: dict[int, ContactsData] = {}
         contacts_info.update(group_info)
         contacts_info.update(friend_info)
         contacts_info = {key: val.model_dump() for key, val in contacts_info.items()}
-        await self.send(text_data=json.dumps(contacts_info))
+        await self.send_frame(self.codec.dumps(contacts_info))
 
+    @rcv.on(MessageType.FUNC_READ_MESSAGE)
     async def rcv_read_message(self, message: Message):
-        message_id = int(message.content)
+        # handled together with the other messages read within CHAT_READ_RECEIPT_DELAY
+        await self.read_receipts.push(int(message.content), message)
+
+    async def send_read_receipts(self, read: dict[int, Message]):
         try:
-            (
-                message_sender,
-                message_receiver,
-                message_t_type,
-            ) = await db_add_read_message(self.group_list + self.friend_list, message_id, self.user_id)
-        except KeyError as e:
-            message.content = str(e)
+            receipts, errors = await db_read_messages(self.contacts, list(read), self.user_id)
+        except Exception as e:
+            print(f"cannot record read messages: {str(e)}")
+            receipts, errors = [], {message_id: "cannot record read message" for message_id in read}
+        for message_id, error in errors.items():
+            message = read[message_id]
+            message.content = error
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
-            return
-        message.receiver = message_receiver
-        message.t_type = message_t_type
-        message.sender = message_sender
-        await self.send_message_to_target(message, str(self.user_id))
-        await self.send_message_to_target(message, str(message_sender))
+        # one receipt per conversation, for its latest message read; earlier ones
+        # are covered by the read cursor
+        for latest, senders in receipts:
+            message = read[latest.message_id]
+            message.receiver = latest.receiver
+            message.t_type = latest.t_type
+            message.sender = latest.sender
+            message.who_read = [self.user_id]
+            await self.send_message_to_targets(
+                message, list(dict.fromkeys([self.user_id, *senders]))
+            )
 
+    @rcv.on(MessageType.FUNC_LEAVE_GROUP)
     async def rcv_leave_group(self, message: Message):
         group_id = message.receiver
         user_id = self.user_id
         try:
-            group_other_members = await db_reduce_person(group_id, user_id)
+            group_other_members, version = await db_reduce_person(group_id, user_id)
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
+        await globalRabbitMQPool.unbind_group_members(self.channel, group_id, [user_id])
+        message.delta = ContactsDelta(
+            group_id=group_id, version=version, removed_members=[user_id]
+        )
+        await self.group_changed(message.delta)
         message.sender = user_id
         message.content = "user:id=" + str(user_id) + " leave group"
-        for member in group_other_members:
-            await self.send_message_to_target(message, str(member))
-        await self.send_message_to_target(message, str(user_id))
+        await self.send_message_to_targets(message, group_other_members + [user_id])
 
+    @rcv.on(MessageType.FUNC_CHANGE_GROUP_OWNER)
     async def rcv_change_group_owner(self, message: Message):
         group_old_owner = self.user_id
         group_new_owner = message.receiver
@@ -501,26 +649,35 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        if group_id not in self.group_list:
+        if not self.contacts.is_group(group_id):
             message.content = "You are not in this group"
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        if group_new_owner not in self.group_members[group_id]:
+        if group_new_owner not in self.contacts.members_of(group_id):
             message.content = "This user is not in this group"
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
         try:
-            await db_change_group_owner(group_id, group_old_owner, group_new_owner)
+            version = await db_change_group_owner(
+                group_id, group_old_owner, group_new_owner
+            )
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        for member in self.group_members[group_id]:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(
+            group_id=group_id, version=version, owner=group_new_owner
+        )
+        await self.group_changed(message.delta)
+        await self.send_message_to_group(message, group_id)
 
+    @rcv.on(
+        MessageType.FUNC_ADD_GROUP_ADMIN,
+        MessageType.FUNC_REMOVE_GROUP_ADMIN,
+    )
     async def rcv_add_or_reduce_admin(self, message: Message):
         group_id = message.content
         group_admin = message.receiver
@@ -529,30 +686,47 @@ class ChatConsumer(AsyncWebsocketConsumer):
         else:
             if_add = True
         try:
-            await db_add_or_remove_admin(group_id, group_admin, self.user_id, if_add)
+            version = await db_add_or_remove_admin(
+                group_id, group_admin, self.user_id, if_add
+            )
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        for member in self.group_members[group_id]:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(group_id=group_id, version=version)
+        if if_add:
+            message.delta.added_admins = [group_admin]
+        else:
+            message.delta.removed_admins = [group_admin]
+        await self.group_changed(message.delta)
+        await self.send_message_to_group(message, group_id)
 
+    @rcv.on(MessageType.FUNC_REMOVE_GROUP_MEMBER)
     async def rcv_remove_group_member(self, message: Message):
         group_id = message.content
         group_member = message.receiver
         try:
-            await db_group_remove_member(group_id, group_member, self.user_id)
+            version = await db_group_remove_member(group_id, group_member, self.user_id)
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        self.group_members[group_id].remove(group_member)
-        for member in self.group_members[group_id]:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(
+            group_id=group_id, version=version, removed_members=[group_member]
+        )
+        await self.group_changed(message.delta)
+        await globalRabbitMQPool.unbind_group_members(
+            self.channel, group_id, [group_member]
+        )
+        await self.send_message_to_group(message, group_id)
         await self.send_message_to_target(message, str(group_member))
 
+    @rcv.on(
+        MessageType.FUNC_MESSAGE_ADD_BROADCAST,
+        MessageType.FUNC_MESSAGE_DEL_BROADCAST,
+    )
     async def rcv_add_or_del_top_message(self, message: Message):
         group_id = message.receiver
         message_id = message.content
@@ -567,9 +741,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
-        for member in self.group_members[group_id]:
-            await self.send_message_to_target(message, str(member))
+        await self.send_message_to_group(message, group_id)
 
+    @rcv.on(MessageType.FUNC_RECALL_MEMBER_MESSAGE)
     async def rcv_callback_member_message(self, message: Message):
         message_id = message.content
         group_id = message.receiver
@@ -585,6 +759,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         await self._forward_message(message)
 
+    @rcv.on(MessageType.FUNC_DELETE_MESSAGE)
     async def rcv_delete_message(self, message: Message):
         message_id = message.content
         user_id = self.user_id
@@ -597,6 +772,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         await self.send_message_to_target(message, str(self.user_id))
 
+    @rcv.on(MessageType.FUNC_EDIT_MESSAGE)
     async def rcv_edit_message(self, message: Message):
         new_content = message.content
         user_id = self.user_id
@@ -609,12 +785,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_message_to_front(message)
             return
         if type(receiver) == int:
-            await self.send_message_to_target(message, str(receiver))
-            await self.send_message_to_target(message, str(self.user_id))
+            await self.send_message_to_targets(message, [receiver, self.user_id])
         elif type(receiver) == list:
-            for member in receiver:
-                await self.send_message_to_target(message, str(member))
+            await self.send_message_to_targets(message, receiver)
 
+    @rcv.on(MessageType.FUNC_RECALL_SELF_MESSAGE)
     async def rcv_callback_self_message(self, message: Message):
         message_id = message.content
         user_id = self.user_id
@@ -627,6 +802,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         await self._forward_message(message)
 
+    @rcv.on(MessageType.FUNC_EDIT_PROFILE)
     async def rcv_edit_profile(self, message: Message):
         message.sender = self.user_id
         message.receiver = self.user_id
@@ -640,6 +816,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         await self.send_message_to_target(message, str(self.user_id))
 
+    @rcv.on(MessageType.FUNC_DELETE_GROUP)
     async def rcv_delete_group(self, message: Message):
         group_id = message.content
         try:
@@ -650,23 +827,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_message_to_front(message)
             return
         message.sender = self.user_id
-        for member in group_member:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(group_id=group_id, deleted=True)
+        await self.group_changed(message.delta)
+        await self.send_message_to_targets(message, group_member)
+        await globalRabbitMQPool.delete_group(self.channel, group_id)
 
+    @rcv.on(MessageType.FUNC_CHANGE_GROUP_NAME)
     async def rcv_change_group_name(self, message: Message):
         group_id = message.receiver
         group_name = message.content
         try:
-            group_list = await db_change_group_name(group_id, group_name, self.user_id)
+            group_list, version = await db_change_group_name(
+                group_id, group_name, self.user_id
+            )
         except KeyError as e:
             message.content = str(e)
             message.t_type = TargetType.ERROR
             await self.send_message_to_front(message)
             return
         message.sender = self.user_id
-        for member in group_list:
-            await self.send_message_to_target(message, str(member))
+        message.delta = ContactsDelta(group_id=group_id, version=version, name=group_name)
+        await self.group_changed(message.delta)
+        await self.send_message_to_targets(message, group_list)
 
+    @rcv.fallback
     async def rcv_handle_common_message(self, message_received: Message):
         if (    message_received.info is not None
                 and "reference" in message_received.info
@@ -697,7 +881,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def _forward_message(self, message_received):
         if message_received.t_type == TargetType.FRIEND:  # send message to friend
-            if message_received.receiver in self.friend_list:
+            if message_received.receiver in self.contacts.friends:
                 try:
                     if_deleted = await db_check_friend_if_deleted(self.user_id, message_received.receiver)
                 except KeyError as e:
@@ -716,13 +900,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         time=int(time.time() * 1000),
                         who_read=[],
                     )
-                    message_json = new_message.model_dump_json()
-                    await self.storage_exchange.publish(
-                        aio_pika.Message(
-                            body=message_json.encode(),  # turn message into bytes
-                        ),
-                        routing_key="",
-                    )
+                    await self.publish_to_storage(new_message)
                     await self.send_message_to_target(new_message, str(new_message.receiver))
                 else:
                     await self.send_message_to_target(
@@ -734,66 +912,201 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_message_to_front(message_received)
                 return
         elif message_received.t_type == TargetType.GROUP:
-            group_member = self.group_members[
-                message_received.receiver
-            ]  # receiver is group id
-            for member in group_member:
-                await self.send_message_to_target(message_received, str(member))
+            # receiver is group id
+            await self.send_message_to_group(message_received, message_received.receiver)
         await self.send_message_to_target(message_received, str(self.user_id))
 
     async def callback(self, body: AbstractIncomingMessage):
-        message = Message.model_validate_json(body.body.decode())
+        incoming = BrokerMessage(body.body, body.content_type)
+        frame = incoming.frame(self.codec)
         ack_callback = body.channel.basic_ack(delivery_tag=body.delivery_tag)
+        self.ack_manager.hold(body.delivery_tag)
 
         async def push_message(retry=self.retry):
             if retry == 0:
+                # never acknowledged, the client loads it from history; settle the
+                # delivery so it stops taking a prefetch slot
+                self.ack_manager.release(body.delivery_tag)
+                await body.reject(requeue=False)
+                await self.update_flow()
                 return
-            await self.send_message_to_front(message)
-            print("pushed", retry, message.model_dump())
+            await self.push_frame(frame)
+            print("pushed", retry, incoming.message_id)
             self.ack_manager.manage(
-                message.message_id, ack_callback, push_message(retry - 1), self.timeout
+                incoming.message_id,
+                ack_callback,
+                push_message(retry - 1),
+                self.timeout,
+                delivery_tag=body.delivery_tag,
             )
 
-        async def empty(_):
-            pass
-
-        handler: Callable[[Message], Any] = {
-            MessageType.FUNC_CREATE_GROUP: self.cb_fresh_group_info,
-            MessageType.FUNC_ADD_GROUP_MEMBER: self.cb_fresh_group_info,
-            MessageType.FUNC_ACCEPT_FRIEND: self.cb_fresh_friend_info,
-            MessageType.FUNC_DEL_FRIEND: self.cb_fresh_friend_info,
-            MessageType.FUNC_BlOCK_FRIEND: self.cb_fresh_friend_info,
-            MessageType.FUNC_UNBLOCK_FRIEND: self.cb_fresh_friend_info,
-            MessageType.FUNC_LEAVE_GROUP: self.cb_fresh_group_info,
-            MessageType.FUNC_CHANGE_GROUP_OWNER: self.cb_fresh_group_info,
-            MessageType.FUNC_ADD_GROUP_ADMIN: self.cb_fresh_group_info,
-            MessageType.FUNC_REMOVE_GROUP_ADMIN: self.cb_fresh_group_info,
-            MessageType.FUNC_REMOVE_GROUP_MEMBER: self.cb_fresh_group_info,
-            MessageType.FUNC_DELETE_GROUP: self.cb_fresh_group_info,
-        }.get(message.m_type, empty)
-        await handler(message)
+        if incoming.m_type in self.cb:
+            # only state changing events pay for building the full Message
+            await self.cb.dispatch(self, incoming.m_type, incoming.message())
 
         await push_message()
+        await self.update_flow()
 
+    async def update_flow(self):
+        """
+        pause consuming while the client lags behind, resume once it caught up
+        """
+        if self.queue is None:
+            return
+        backlog = self.ack_manager.in_flight + (
+            len(self.outbound) if self.outbound is not None else 0
+        )
+        async with self.flow_lock:
+            if self.consumer_tag is not None and backlog >= settings.CHAT_PAUSE_BACKLOG:
+                consumer_tag, self.consumer_tag = self.consumer_tag, None
+                print("pause consuming, backlog", backlog)
+                await self.queue.cancel(consumer_tag)
+            elif self.consumer_tag is None and backlog <= settings.CHAT_RESUME_BACKLOG:
+                print("resume consuming, backlog", backlog)
+                self.consumer_tag = await self.queue.consume(self.callback)
 
-    async def cb_fresh_friend_info(self, _: Message):
-        self.friend_list = await db_query_friends(self.user_id)
+    async def ack_multiple(self, delivery_tag: int):
+        channel = await self.channel.get_underlay_channel()
+        await channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
 
-    async def cb_fresh_group_info(self, _: Message):
-        await self.fresh_group_info()
+    @cb.on(
+        MessageType.FUNC_ACCEPT_FRIEND,
+        MessageType.FUNC_DEL_FRIEND,
+        MessageType.FUNC_BlOCK_FRIEND,
+        MessageType.FUNC_UNBLOCK_FRIEND,
+    )
+    async def cb_fresh_friend_info(self, message: Message):
+        if message.delta is None:  # sent by an older worker
+            self.contacts.set_friends(await db_query_friends(self.user_id))
+            return
+        self.contacts.apply_friends(message.delta, self.user_id)
+
+    @cb.on(
+        MessageType.FUNC_CREATE_GROUP,
+        MessageType.FUNC_ADD_GROUP_MEMBER,
+        MessageType.FUNC_LEAVE_GROUP,
+        MessageType.FUNC_CHANGE_GROUP_OWNER,
+        MessageType.FUNC_ADD_GROUP_ADMIN,
+        MessageType.FUNC_REMOVE_GROUP_ADMIN,
+        MessageType.FUNC_REMOVE_GROUP_MEMBER,
+        MessageType.FUNC_DELETE_GROUP,
+        MessageType.FUNC_CHANGE_GROUP_NAME,
+    )
+    async def cb_fresh_group_info(self, message: Message):
+        delta = message.delta
+        if delta is None:  # sent by an older worker
+            await self.fresh_group_info()
+        elif delta.group_id is not None and not self.contacts.apply_group(
+            delta, self.user_id
+        ):
+            # a version gap, some change of this group was missed
+            await self.fresh_one_group(delta.group_id, delta.version or 0)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        # keep frame order: anything still buffered goes out first
+        if self.outbound is not None:
+            await self.outbound.flush()
+        await super().send(text_data, bytes_data, close)
+
+    async def _send_raw(self, frame: str | bytes):
+        if isinstance(frame, bytes):
+            await super().send(bytes_data=frame)
+        else:
+            await super().send(text_data=frame)
+
+    async def send_frame(self, frame: str | bytes):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
     async def send_message_to_front(self, message_sent: Message):
-        await self.send(
-            text_data=message_sent.model_dump_json()
-        )  # send message to front no matter if it is user own message
+        # send message to front no matter if it is user own message
+        await self.push_frame(self.codec.encode_model(message_sent))
+
+    async def push_frame(self, frame: str | bytes):
+        if self.outbound is not None:
+            await self.outbound.push(frame)
+            return
+        await self.send_frame(frame)
+
+    async def publish_to_storage(self, message: Message):
+        await self.storage_exchange.publish(
+            aio_pika.Message(
+                body=encode_body(message),
+                content_type=broker_codec.content_type,
+            ),
+            routing_key="",
+        )
 
     async def send_message_to_target(self, message: Message, receiver: str):
-        message_json = message.model_dump_json()
-        exchange_name = "user_" + receiver
-        aim_exchange = await self.channel.declare_exchange(exchange_name, type="fanout")
+        if message.m_type < MessageType.FUNCTION and not await globalPresenceRegistry.online(
+            [int(receiver)]
+        ):
+            return  # offline, the message is loaded from history on next login
+        await self._publish(encode_body(message), "user_" + receiver)
+
+    async def send_message_to_targets(self, message: Message, receivers):
+        """
+        publish one message to many users, serializing it only once
+
+        receivers are delivered concurrently, at most ``fanout_concurrency`` at a time;
+        repeated publishes to the same receiver stay sequential to keep its order.
+        a failed receiver is retried once, then the sender gets an error frame
+
+        :param message: message to publish
+        :param receivers: user ids of the receivers
+        """
+        body = encode_body(message)
+        counts = Counter(receivers)
+        if message.m_type < MessageType.FUNCTION:
+            # offline users load persisted messages from history on their next login
+            online = await globalPresenceRegistry.online([int(r) for r in counts])
+            counts = Counter({r: times for r, times in counts.items() if int(r) in online})
+        semaphore = asyncio.Semaphore(self.fanout_concurrency)
+
+        async def deliver(receiver):
+            async with semaphore:
+                while counts[receiver] > 0:
+                    await self._publish(body, "user_" + str(receiver))
+                    counts[receiver] -= 1  # a retry does not repeat what went out
+
+        pending = list(counts)
+        for _ in range(2):
+            results = await asyncio.gather(
+                *(deliver(receiver) for receiver in pending),
+                return_exceptions=True,
+            )
+            errors = {
+                receiver: result
+                for receiver, result in zip(pending, results)
+                if isinstance(result, Exception)
+            }
+            if not errors:
+                return
+            pending = list(errors)
+        print("failed to publish to", errors)
+        error = message.model_copy(
+            update={
+                "t_type": TargetType.ERROR,
+                "content": "cannot deliver to " + ", ".join(str(r) for r in errors),
+            }
+        )
+        await self.send_message_to_front(error)
+
+    async def send_message_to_group(self, message: Message, group_id: int):
+        # members' exchanges are bound to the group exchange, so one publish reaches all of them
+        await globalRabbitMQPool.sync_group(
+            self.channel, group_id, self.contacts.version_of(group_id)
+        )
+        await self._publish(encode_body(message), "group_" + str(group_id))
+
+    async def _publish(self, body: bytes, exchange_name: str):
+        aim_exchange = await globalRabbitMQPool.get_exchange(self.channel, exchange_name)
         await aim_exchange.publish(
             aio_pika.Message(
-                body=message_json.encode(),
+                body=body,
+                content_type=broker_codec.content_type,
             ),
             routing_key="",  # do not specify routing key
         )
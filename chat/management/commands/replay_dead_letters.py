@@ -0,0 +1,59 @@
+import pika
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.storage import DEAD_QUEUE, STORAGE_QUEUE
+
+
+class Command(BaseCommand):
+    help = "Send the messages of the storage dead letter queue back to PermStore"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=0,
+            help="replay at most this many messages, 0 for all",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only list why the messages failed, they stay in the queue",
+        )
+
+    def handle(self, *args, **options):
+        connection = pika.BlockingConnection(pika.URLParameters(settings.RABBITMQ_URL))
+        channel = connection.channel()
+        # a message is only removed from the dead letter queue once PermStore has it
+        channel.confirm_delivery()
+        replayed = 0
+        try:
+            # messages failing again come back to the end of the queue, stop before them
+            try:
+                count = channel.queue_declare(queue=DEAD_QUEUE, passive=True).method.message_count
+            except pika.exceptions.ChannelClosedByBroker:
+                count = 0  # no storage worker has declared the queue yet
+            if options["limit"] > 0:
+                count = min(count, options["limit"])
+            for _ in range(count):
+                method, properties, body = channel.basic_get(queue=DEAD_QUEUE)
+                if method is None:
+                    break
+                if options["dry_run"]:
+                    error = (properties.headers or {}).get("x-error")
+                    self.stdout.write(f"{body[:64]!r}: {error}")
+                    continue
+                # storing is idempotent, a message stored already is skipped
+                channel.basic_publish(
+                    exchange="",
+                    routing_key=STORAGE_QUEUE,
+                    body=body,
+                    properties=pika.BasicProperties(content_type=properties.content_type),
+                )
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                replayed += 1
+        finally:
+            # unacknowledged messages of a dry run return to the queue
+            connection.close()
+        if not options["dry_run"]:
+            self.stdout.write(f"replayed {replayed} messages")
@@ -0,0 +1,86 @@
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from utils.storage import StoragePipeline
+
+
+async def run_pipeline(report_interval: float):
+    pipeline = StoragePipeline(
+        settings.STORAGE_BATCH_SIZE, settings.STORAGE_FLUSH_INTERVAL, report_interval
+    )
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, pipeline.stop)
+    loop.add_signal_handler(signal.SIGINT, pipeline.stop)
+    await pipeline.run()
+
+
+def storage_worker(report_interval: float):
+    asyncio.run(run_pipeline(report_interval))
+
+
+class Command(BaseCommand):
+    help = "Store the messages of the PermStore queue with a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.STORAGE_WORKERS,
+            help="number of consumer processes",
+        )
+        parser.add_argument(
+            "--report-interval",
+            type=float,
+            default=settings.STORAGE_REPORT_INTERVAL,
+            help="seconds between throughput reports of each worker, 0 to disable",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] > 1 and connections["default"].vendor == "sqlite":
+            self.stderr.write(
+                "sqlite allows a single writer, storage workers will wait for each other"
+            )
+        # workers are forked from this process, they must not share its database connection
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        stopping = False
+
+        def spawn():
+            process = context.Process(
+                target=storage_worker, args=(options["report_interval"],), daemon=True
+            )
+            process.start()
+            return process
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for process in processes:
+                if process is not None and process.is_alive():
+                    process.terminate()  # SIGTERM, the worker flushes its batch and exits
+
+        processes = [spawn() for _ in range(options["workers"])]
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.stdout.write(f"started {len(processes)} storage workers")
+        while processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                process.join()
+                if stopping:
+                    processes[index] = None
+                else:
+                    self.stderr.write(
+                        f"storage worker {process.pid} exited with {process.exitcode}, restarting"
+                    )
+                    processes[index] = spawn()
+            processes = [process for process in processes if process is not None]
+        self.stdout.write("storage workers stopped")
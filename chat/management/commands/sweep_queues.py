@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+import pika
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.models import Device
+
+
+class Command(BaseCommand):
+    help = "Delete the RabbitMQ queues of devices that have been inactive for a while"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CHAT_DEVICE_INACTIVE_DAYS,
+            help="devices not seen for this many days are swept",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only list the devices that would be swept",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        devices = Device.objects.filter(last_seen__lt=cutoff)
+        if options["dry_run"]:
+            for device in devices:
+                self.stdout.write(f"{device.browser} (user {device.user_id})")
+            return
+        connection = pika.BlockingConnection(pika.URLParameters(settings.RABBITMQ_URL))
+        channel = connection.channel()
+        swept = 0
+        skipped = 0
+        try:
+            for device in devices.iterator():
+                # last_seen is only written on connect and disconnect, a socket open for
+                # longer than the cutoff still consumes its queue
+                try:
+                    consumers = channel.queue_declare(
+                        queue=device.browser, passive=True
+                    ).method.consumer_count
+                except pika.exceptions.ChannelClosedByBroker:
+                    channel = connection.channel()  # the queue expired already
+                    consumers = 0
+                if consumers:
+                    device.save(update_fields=["last_seen"])  # seen now, by its consumer
+                    skipped += 1
+                    continue
+                # unbind from the user's exchange first, so no new copies arrive while deleting
+                try:
+                    channel.queue_unbind(
+                        queue=device.browser, exchange="user_" + str(device.user_id)
+                    )
+                except pika.exceptions.ChannelClosedByBroker:
+                    # queue or exchange already gone (e.g. expired), the broker closed the channel
+                    channel = connection.channel()
+                try:
+                    channel.queue_delete(queue=device.browser, if_unused=True)
+                except pika.exceptions.ChannelClosedByBroker:
+                    # a consumer attached since the check, give the queue its binding back
+                    channel = connection.channel()
+                    channel.queue_bind(
+                        queue=device.browser, exchange="user_" + str(device.user_id)
+                    )
+                    skipped += 1
+                    continue
+                device.delete()
+                swept += 1
+        finally:
+            connection.close()
+        self.stdout.write(f"swept {swept} device queues, skipped {skipped} still consumed")
@@ -1,9 +1,39 @@
-from django.test import TestCase
+import asyncio
+from collections import Counter
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase, override_settings
 import json
 from files.models import Multimedia
-from users.models import User, MessageList
+from users.models import Friendship, GroupList, User, MessageList
+from utils.ack_manager import AckManager, AckScheduler
+from utils.codec import (
+    BrokerMessage,
+    JsonCodec,
+    MsgpackCodec,
+    broker_codec,
+    codec_for_subprotocols,
+    decode_body,
+    encode_body,
+)
+from utils.contacts import ContactState
+from utils.data import ContactsDelta, Message, MessageType, TargetType
+from utils.handlers import HandlerRegistry, handler_stats
+from utils.idempotency import MemoryIdempotencyStore
+from utils.membership import GroupMembershipCache
+from utils.outbound import OutboundBuffer
+from utils.presence import MemoryPresenceRegistry
+from utils.rabbitmq import ExchangeCache, PooledConnection, RabbitMQPool
+from utils.read_cursors import advance_read_cursors, read_by, unread_counts
+from utils.read_receipts import ReadReceiptBuffer
+from utils.db_fun import db_query_group_state, db_read_messages
+from utils.singleflight import singleflight
+from django.db import OperationalError
+from utils.storage import StoragePipeline, message_to_row, retry_locked, write_rows
 from utils.utils_jwt import hash_string_with_sha256
 from django.urls import reverse
+from chat.consumers import ChatConsumer
 
 
 class HistoryTestCase(TestCase):
@@ -58,3 +88,897 @@ class HistoryTestCase(TestCase):
         print("---------------")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["content"], "test")
+
+
+class IdempotencyStoreTestCase(TestCase):
+    def test_memory_store(self):
+        store = MemoryIdempotencyStore(max_size=2, ttl=60)
+        claim = async_to_sync(store.claim)
+        self.assertIsNone(claim(1, "browser", "tmp1", 101))
+        self.assertIsNone(claim(2, "browser", "tmp1", 201))
+        # a retry gets the id of the first attempt
+        self.assertEqual(claim(1, "browser", "tmp1", 102), 101)
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(claim(1, "browser", "tmp2", 103))
+        # oldest entry is evicted once the store is full
+        self.assertIsNone(claim(1, "browser", "tmp1", 104))
+
+    def test_memory_store_devices(self):
+        # temporary ids are only unique per browser, another device may reuse one
+        store = MemoryIdempotencyStore(max_size=10, ttl=60)
+        self.assertIsNone(async_to_sync(store.claim)(1, "phone", "tmp1", 101))
+        self.assertIsNone(async_to_sync(store.claim)(1, "laptop", "tmp1", 102))
+
+    def test_memory_store_concurrent(self):
+        store = MemoryIdempotencyStore(max_size=10, ttl=60)
+
+        async def run():
+            return await asyncio.gather(
+                store.claim(1, "browser", "tmp1", 101), store.claim(1, "browser", "tmp1", 102)
+            )
+
+        self.assertEqual(async_to_sync(run)(), [None, 101])
+
+    def test_memory_store_expire(self):
+        store = MemoryIdempotencyStore(max_size=10, ttl=-1)
+        async_to_sync(store.claim)(1, "browser", "tmp1", 101)
+        self.assertIsNone(async_to_sync(store.claim)(1, "browser", "tmp1", 102))
+
+
+class FakeLoop:
+    # the scheduler only sees this clock, timers fire when the test says so
+    def __init__(self):
+        self.now = 0.0
+        self.tasks = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        return asyncio.TimerHandle(when, callback, (), asyncio.get_running_loop())
+
+    def create_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+class AckManagerTestCase(TestCase):
+    def test_acknowledge_and_reject(self):
+        calls = []
+
+        async def record(name):
+            calls.append(name)
+
+        async def run():
+            loop = FakeLoop()
+            scheduler = AckScheduler(loop)
+            manager = AckManager(scheduler)
+            manager.manage(1, record("ack1"), record("rej1"), 10)
+            manager.manage(2, record("ack2"), record("rej2"), 10)
+            self.assertEqual(manager.pending, 2)
+            await manager.acknowledge(1)
+            self.assertNotIn(1, manager)
+            loop.now = 9.9
+            scheduler._fire()
+            self.assertEqual(loop.tasks, [])
+            loop.now = 10
+            scheduler._fire()
+            self.assertEqual(len(loop.tasks), 1)  # the acknowledged one was cancelled
+            await asyncio.gather(*loop.tasks)
+            return manager
+
+        manager = async_to_sync(run)()
+        self.assertEqual(calls, ["ack1", "rej2"])
+        self.assertEqual((manager.pending, manager.acked, manager.rejected), (0, 1, 1))
+        self.assertNotIn(2, manager)
+
+    def test_tasks_only_for_expired(self):
+        async def nothing():
+            pass
+
+        async def closed_socket():
+            raise ConnectionError("socket closed")
+
+        async def run():
+            loop = FakeLoop()
+            scheduler = AckScheduler(loop)
+            manager = AckManager(scheduler)
+            for message_id in range(100):
+                manager.manage(message_id, nothing(), nothing(), 10)
+                await manager.acknowledge(message_id)
+            manager.manage(100, nothing(), closed_socket(), 10)
+            self.assertEqual(len(scheduler), 1)
+            loop.now = 10
+            scheduler._fire()
+            self.assertEqual(len(loop.tasks), 1)
+            await asyncio.wait(loop.tasks)
+            await asyncio.sleep(0)  # done callbacks run on the next iteration
+            return manager, scheduler
+
+        manager, scheduler = async_to_sync(run)()
+        # the failed rejection is logged by the scheduler and the entry still pruned
+        self.assertNotIn(100, manager)
+        self.assertEqual(scheduler.tasks, set())
+        self.assertEqual(manager.rejected, 1)
+
+    def test_acknowledge_batch(self):
+        calls = []
+
+        async def record(name):
+            calls.append(name)
+
+        async def run():
+            manager = AckManager()
+            for message_id, tag in [(10, 1), (11, 2), (12, 3), (13, 4)]:
+                manager.hold(tag)
+                manager.manage(
+                    message_id, record(tag), record(-tag), 1, delivery_tag=tag
+                )
+            # tag 3 is still in flight, so only tags 1 and 2 can be acked cumulatively
+            count = await manager.acknowledge_batch([13], 11, record)
+            return manager, count
+
+        manager, count = async_to_sync(run)()
+        self.assertEqual(count, 3)
+        self.assertEqual(calls, [2, 4])
+        self.assertEqual(manager.outstanding, {3})
+        self.assertIn(12, manager)
+
+
+class HandlerRegistryTestCase(TestCase):
+    def test_dispatch_and_stats(self):
+        registry = HandlerRegistry("test")
+        calls = []
+
+        class Consumer:
+            @registry.on(1, 2)
+            async def double(self, message):
+                return message * 2
+
+            @registry.fallback
+            async def broken(self, message):
+                raise ValueError(message)
+
+        @registry.use
+        async def trace(consumer, message, call_next):
+            calls.append(message)
+            return await call_next()
+
+        consumer = Consumer()
+        self.assertEqual(async_to_sync(registry.dispatch)(consumer, 2, 21), 42)
+        with self.assertRaises(ValueError):
+            async_to_sync(registry.dispatch)(consumer, 3, 0)
+        self.assertEqual(calls, [21, 0])
+        stats = handler_stats()["test"]
+        double, broken = Consumer.double.__qualname__, Consumer.broken.__qualname__
+        self.assertEqual((stats[double]["calls"], stats[double]["errors"]), (1, 0))
+        self.assertEqual((stats[broken]["calls"], stats[broken]["errors"]), (1, 1))
+        self.assertEqual(sum(stats[double]["buckets"].values()), 1)
+
+    def test_same_names(self):
+        registry = HandlerRegistry("test_same_names")
+
+        class First:
+            @registry.on(1)
+            async def handle(self, message):
+                pass
+
+        class Second:
+            @registry.on(2)
+            async def handle(self, message):
+                pass
+
+        async_to_sync(registry.dispatch)(First(), 1, None)
+        stats = handler_stats()["test_same_names"]
+        self.assertEqual(stats[First.handle.__qualname__]["calls"], 1)
+        self.assertEqual(stats[Second.handle.__qualname__]["calls"], 0)
+        with self.assertRaises(ValueError):
+            HandlerRegistry("test_same_names")
+
+
+class ContactStateTestCase(TestCase):
+    def test_shared_reload(self):
+        cache = GroupMembershipCache(None)
+        contacts, other = ContactState(cache), ContactState(cache)
+        contacts.set_friends([1, 2])
+        contacts.set_groups(
+            [10, 11], {10: [1, 3], 11: [3]}, {}, {10: 1}, {10: [3]}, {10: 4, 11: 0}
+        )
+        other.set_groups([10], {10: [1, 3]}, {}, {10: 1}, {10: [3]}, {10: 4})
+        self.assertIn(2, contacts)
+        self.assertIn(11, contacts)
+        self.assertNotIn(3, contacts)
+        self.assertIs(contacts.members_of(10), other.members_of(10))
+        contacts.set_groups([10], {10: [1, 4]}, {}, {}, {}, {10: 5})
+        self.assertEqual(other.members_of(10), {1, 4})
+        self.assertNotIn(11, cache.entries)
+        contacts.set_group(10, (frozenset([4]), "g", 4, frozenset(), 6), 1)
+        self.assertNotIn(10, contacts)
+        self.assertEqual(other.members_of(10), {4})
+        other.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_apply_delta(self):
+        contacts = ContactState(GroupMembershipCache(None))
+        contacts.set_groups([10], {10: [1, 3]}, {}, {10: 1}, {10: [3]}, {10: 4})
+        # stale and next versions apply, a gap asks for a reload
+        delta = ContactsDelta(group_id=10, version=5, removed_members=[3])
+        self.assertTrue(contacts.apply_group(delta, 1))
+        self.assertTrue(contacts.apply_group(delta, 1))
+        entry = contacts.cache.get(10)
+        self.assertEqual((entry.members, entry.admins), ({1}, set()))
+        self.assertFalse(
+            contacts.apply_group(ContactsDelta(group_id=10, version=7, name="x"), 1)
+        )
+        self.assertEqual(contacts.version_of(10), 5)
+        # being removed never needs a reload
+        contacts.apply_group(ContactsDelta(group_id=10, version=9, removed_members=[1]), 1)
+        self.assertNotIn(10, contacts)
+        contacts.apply_friends(ContactsDelta(friends=[1, 2], friendship=1), 1)
+        contacts.apply_friends(ContactsDelta(friends=[2, 3], friendship=1), 1)
+        self.assertEqual(contacts.friends, {2})
+
+    def test_failed_announcement(self):
+        class Announcement:
+            def __init__(self, body):
+                self.body = body
+
+        async def unavailable(group_id):
+            raise ConnectionError("database unavailable")
+
+        cache = GroupMembershipCache(None)
+        contacts = ContactState(cache)
+        contacts.set_groups([10], {10: [1, 3]}, {}, {10: 1}, {}, {10: 4})
+        with patch("utils.membership.db_query_group_state", unavailable):
+            async_to_sync(cache._on_announce)(Announcement(b"not json"))
+            async_to_sync(cache._on_announce)(Announcement(b'{"group_id": 10, "version": 5}'))
+        # kept for its holders, but the next delta asks for a reload
+        self.assertEqual(contacts.members_of(10), {1, 3})
+        self.assertFalse(
+            contacts.apply_group(ContactsDelta(group_id=10, version=5, name="x"), 1)
+        )
+        contacts.set_group(10, (frozenset([1, 3]), "x", 1, frozenset(), 5), 1)
+        self.assertTrue(
+            contacts.apply_group(ContactsDelta(group_id=10, version=6, name="y"), 1)
+        )
+
+
+class SingleFlightTestCase(TestCase):
+    def test_concurrent_calls_share_one(self):
+        calls = []
+
+        @singleflight()
+        async def load(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return [key]
+
+        async def run():
+            return await asyncio.gather(load(1), load(1), load(2))
+
+        first, second, other = async_to_sync(run)()
+        self.assertIs(first, second)
+        self.assertEqual(other, [2])
+        self.assertEqual(calls, [1, 2])
+        # nothing is kept without ttl
+        async_to_sync(load)(1)
+        self.assertEqual(calls, [1, 2, 1])
+
+
+class PresenceRegistryTestCase(TestCase):
+    def test_devices(self):
+        async def run():
+            registry = MemoryPresenceRegistry(ttl=90)
+            await registry.add(1, "a")
+            await registry.add(1, "b")
+            await registry.add(2, "c")
+            await registry.remove(1, "a")
+            await registry.remove(2, "c")
+            return await registry.online([1, 2, 3])
+
+        self.assertEqual(async_to_sync(run)(), {1})
+
+    def test_expiry(self):
+        now = [1000.0]
+        registry = MemoryPresenceRegistry(ttl=90, clock=lambda: now[0])
+
+        async def run():
+            await registry.add(1, "a")  # connect
+            await registry.add(2, "b")
+            now[0] += 60
+            await registry.add(1, "a")  # heartbeat of the open socket
+            now[0] += 60
+            return await registry.online([1, 2])
+
+        # the socket of user 2 stopped refreshing, e.g. its worker crashed
+        self.assertEqual(async_to_sync(run)(), {1})
+
+
+class StoragePipelineTestCase(TestCase):
+    class Exchange:
+        def __init__(self):
+            self.dead = []
+
+        async def publish(self, message, routing_key):
+            self.dead.append(message.body)
+
+    class Delivery:
+        def __init__(self, body, acks):
+            self.body = body
+            self.content_type = "application/json"
+            self.acks = acks
+
+        async def ack(self, multiple=False):
+            self.acks.append((self.body, multiple))
+
+    def test_batch_and_dead_letter(self):
+        # thread sensitive, so rows are written on the connection of the test case
+        pipeline = StoragePipeline(batch_size=3, interval=1, write=sync_to_async(write_rows))
+        pipeline.dead_exchange = self.Exchange()
+        acks = []
+        bodies = [
+            encode_body(Message(message_id=901, content="a", sender=1, receiver=2, time=1)),
+            b"not a message",
+            encode_body(Message(message_id=902, content="b", sender=1, receiver=2, time=2)),
+        ]
+
+        async def run():
+            stages = [
+                asyncio.create_task(pipeline.decode_stage()),
+                asyncio.create_task(pipeline.write_stage()),
+            ]
+            for body in bodies:
+                await pipeline.received.put(self.Delivery(body, acks))
+            await pipeline.received.join()
+            await pipeline.decoded.join()
+            for stage in stages:
+                stage.cancel()
+
+        async_to_sync(run)()
+        self.assertEqual(acks, [(bodies[2], True)])
+        self.assertEqual(pipeline.dead_exchange.dead, [b"not a message"])
+        self.assertEqual(pipeline.stored, 2)
+        self.assertEqual(
+            list(MessageList.objects.filter(message_id__in=[901, 902]).values_list("content", flat=True)),
+            ['"a"', '"b"'],
+        )
+
+    def test_redelivery(self):
+        row = message_to_row(Message(message_id=903, content="c", sender=1, receiver=2, time=3))
+        self.assertEqual(write_rows([row]), {})
+        duplicate = message_to_row(Message(message_id=903, content="d", sender=1, receiver=2, time=3))
+        self.assertEqual(write_rows([duplicate, row]), {})
+        self.assertEqual(MessageList.objects.get(message_id=903).content, '"c"')
+        # the id was given out again after a restart, the new message is not a duplicate
+        reused = message_to_row(Message(message_id=903, content="e", sender=5, receiver=2, time=4))
+        self.assertEqual(list(write_rows([reused])), [0])
+
+    def test_locked_database(self):
+        attempts = []
+
+        def write():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OperationalError("database is locked")
+            return {}
+
+        self.assertEqual(retry_locked(write), {})
+        self.assertEqual(len(attempts), 3)
+
+        def broken():
+            raise OperationalError("no such table: users_messagelist")
+
+        with self.assertRaises(OperationalError):
+            retry_locked(broken)
+
+
+class ReadCursorTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice", userEmail="alice@qq.com")
+        self.bob = User.objects.create(username="bob", userEmail="bob@qq.com")
+        Friendship.objects.create(user1=self.alice, user2=self.bob, state=1)
+        self.group = GroupList.objects.create(group_id=100, group_name="g", group_owner=self.alice)
+        self.group.group_members.add(self.alice, self.bob)
+        self.messages = [
+            MessageList.objects.create(
+                message_id=message_id, m_type=0, t_type=t_type, time=message_id,
+                content='"x"', sender=self.bob.id, receiver=receiver,
+            )
+            for message_id, t_type, receiver in [
+                (11, 0, self.alice.id), (12, 0, self.alice.id),
+                (13, 1, self.group.group_id), (14, 1, self.group.group_id),
+            ]
+        ]
+
+    def test_watermarks(self):
+        group = (1, self.group.group_id)
+        advance_read_cursors(self.alice.id, {(0, self.bob.id): 11, group: 14})
+        advance_read_cursors(self.alice.id, {group: 13})  # never moves back
+        self.assertEqual(
+            read_by(self.messages),
+            {11: [self.alice.id], 12: [], 13: [self.alice.id], 14: [self.alice.id]},
+        )
+        self.assertEqual(
+            unread_counts(self.alice.id), {"friends": {self.bob.id: 1}, "groups": {}}
+        )
+
+    def test_many_conversations(self):
+        groups = GroupList.objects.bulk_create(
+            GroupList(group_id=1000 + i, group_name="g", group_owner=self.alice) for i in range(1200)
+        )
+        GroupList.group_members.through.objects.bulk_create(
+            GroupList.group_members.through(grouplist_id=group.group_id, user_id=self.alice.id)
+            for group in groups
+        )
+        MessageList.objects.create(
+            message_id=15, m_type=0, t_type=1, time=15, content='"x"', sender=self.bob.id, receiver=1005
+        )
+        counts = unread_counts(self.alice.id)
+        self.assertEqual(counts["groups"], {self.group.group_id: 2, 1005: 1})
+
+    def test_read_receipts(self):
+        flushed = []
+
+        async def flush(read):
+            flushed.append(await db_read_messages({self.bob.id}, list(read), self.alice.id))
+
+        async def scroll():
+            buffer = ReadReceiptBuffer(flush, delay=10, max_items=3)
+            for message_id in (11, 12, 99):
+                await buffer.push(message_id, Message(m_type=19, content=message_id))
+            await buffer.push(13, Message(m_type=19, content=13))
+            await buffer.flush()
+
+        async_to_sync(scroll)()
+        (receipts, errors), (group_receipts, _) = flushed
+        self.assertEqual([(m.message_id, senders) for m, senders in receipts], [(12, {self.bob.id})])
+        self.assertEqual(errors, {99: "message not exist"})
+        self.assertEqual(group_receipts, [])  # not in the contacts given
+        self.assertEqual(read_by(self.messages)[12], [self.alice.id])
+
+
+
+class OutboundBufferTestCase(TestCase):
+    def test_max_items_and_timer(self):
+        frames = []
+
+        async def run():
+            sent = asyncio.Event()
+
+            async def send(frame):
+                frames.append(frame)
+                sent.set()
+
+            buffer = OutboundBuffer(send, lambda items: "[" + ",".join(items) + "]", 0.01, 2)
+            await buffer.push("1")
+            await buffer.push("2")  # full, sent at once
+            sent.clear()
+            await buffer.push("3")
+            await asyncio.wait_for(sent.wait(), 5)
+
+        async_to_sync(run)()
+        self.assertEqual(frames, ["[1,2]", "[3]"])
+
+    def test_timer_failure_and_discard(self):
+        frames = []
+
+        async def run():
+            sent = asyncio.Event()
+
+            async def send(frame):
+                sent.set()
+                if not frames:
+                    frames.append(None)
+                    raise ConnectionError("socket closed")
+                frames.append(frame)
+
+            buffer = OutboundBuffer(send, lambda items: ",".join(items), 0.01, 10)
+            await buffer.push("1")
+            await asyncio.wait_for(sent.wait(), 5)  # failed, logged by the timer task
+            sent.clear()
+            await buffer.push("2")
+            await asyncio.wait_for(sent.wait(), 5)
+            await buffer.push("3")
+            buffer.discard()
+            await buffer.push("4")  # discarded, dropped
+            await asyncio.sleep(0.05)
+            return len(buffer), buffer.tasks
+
+        self.assertEqual(async_to_sync(run)(), (0, set()))
+        self.assertEqual(frames, [None, "2"])
+
+
+class ReadReceiptBufferTestCase(TestCase):
+    def test_timer_and_failure(self):
+        batches = []
+
+        async def run():
+            flushed = asyncio.Event()
+
+            async def flush(read):
+                batches.append(sorted(read))
+                flushed.set()
+                if len(batches) == 1:
+                    raise RuntimeError("broker unavailable")
+
+            buffer = ReadReceiptBuffer(flush, delay=0.01, max_items=10)
+            await buffer.push(1, Message(m_type=19, content=1))
+            await buffer.push(2, Message(m_type=19, content=2))
+            await asyncio.wait_for(flushed.wait(), 5)
+            # the failed flush was logged and a later event starts a new timer
+            flushed.clear()
+            await buffer.push(3, Message(m_type=19, content=3))
+            await asyncio.wait_for(flushed.wait(), 5)
+
+        async_to_sync(run)()
+        self.assertEqual(batches, [[1, 2], [3]])
+
+    def test_close_waits_for_timer(self):
+        batches = []
+
+        async def run():
+            started, release = asyncio.Event(), asyncio.Event()
+
+            async def flush(read):
+                started.set()
+                await release.wait()
+                batches.append(sorted(read))
+
+            buffer = ReadReceiptBuffer(flush, delay=0.01, max_items=10)
+            await buffer.push(1, Message(m_type=19, content=1))
+            await asyncio.wait_for(started.wait(), 5)
+            await buffer.push(2, Message(m_type=19, content=2))  # while the timer flushes
+            closing = asyncio.create_task(buffer.close())
+            await asyncio.sleep(0)
+            self.assertFalse(closing.done())
+            release.set()
+            await closing
+            await buffer.push(3, Message(m_type=19, content=3))  # closed, dropped
+            return len(buffer)
+
+        self.assertEqual(async_to_sync(run)(), 0)
+        self.assertEqual(batches, [[1], [2]])
+
+
+class FakeExchange:
+    def __init__(self, name, broker):
+        self.name = name
+        self.broker = broker
+        self.recorded = set()  # replayed on reconnect, like a robust exchange
+
+    async def bind(self, source):
+        self.broker.add((source.name, self.name))
+        self.recorded.add(source.name)
+
+    async def unbind(self, source):
+        self.broker.discard((source.name, self.name))
+        self.recorded.discard(source.name)
+
+
+class Callbacks(list):
+    add = list.append
+
+
+class FakeBrokerChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_closed = False
+        self.close_callbacks = Callbacks()
+
+    async def declare_exchange(self, name, type):
+        exchange = FakeExchange(name, self.connection.broker)
+        self.connection.exchanges.append(exchange)
+        return exchange
+
+    async def close(self):
+        self.is_closed = True
+        for callback in self.close_callbacks:
+            callback(self)
+
+
+class FakeConnection:
+    # a robust connection with the parts RabbitMQPool uses
+    def __init__(self):
+        self.broker = set()
+        self.exchanges = []
+        self.channels = []
+        self.reconnect_callbacks = Callbacks()
+        self.is_closed = False
+
+    async def channel(self):
+        channel = FakeBrokerChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def reconnect(self):
+        for exchange in self.exchanges:
+            self.broker.update((source, exchange.name) for source in exchange.recorded)
+        for callback in self.reconnect_callbacks:
+            callback(self)
+
+
+class GroupBindingTestCase(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create(username=name, userEmail=f"{name}@qq.com")
+            for name in ("alice", "bob", "carol")
+        ]
+        self.group = GroupList.objects.create(group_id=100, group_name="g", group_owner=self.users[0])
+        self.group.group_members.add(self.users[0], self.users[1])
+        db_query_group_state.forget(100)
+
+    def bound(self, connection):
+        return {user for group, user in connection.broker if group == "group_100"}
+
+    def test_stale_cache_and_reconnect(self):
+        alice, bob, carol = (f"user_{user.id}" for user in self.users)
+        connection = FakeConnection()
+        pool = RabbitMQPool("amqp://", 1, 10, 100)
+
+        async def run():
+            pooled = PooledConnection(connection, 100)
+            connection.reconnect_callbacks.add(lambda *_: pool._schedule_resync(pooled))
+            pool.connections, pool.owners = [pooled], {"channel": pooled}
+            # carol was removed, but is still in the member list of some consumer
+            await pool.bind_group_members("channel", 100, [self.users[2].id])
+            await pool.sync_group("channel", 100)
+            synced = self.bound(connection)
+            # another node removes bob while this one is disconnected
+            await sync_to_async(self.group.group_members.remove)(self.users[1])
+            connection.broker.discard(("group_100", bob))
+            connection.reconnect()
+            await asyncio.gather(*pool.tasks)
+            return synced, self.bound(connection)
+
+        synced, resynced = async_to_sync(run)()
+        self.assertEqual(synced, {alice, bob})
+        self.assertEqual(resynced, {alice})
+
+
+class RabbitMQPoolTestCase(TestCase):
+    def test_slots_and_wait(self):
+        opened = []
+
+        async def connect_robust(url):
+            opened.append(FakeConnection())
+            return opened[-1]
+
+        async def run():
+            pool = RabbitMQPool("amqp://", 2, 2, 100)
+            first = [await pool.acquire_channel() for _ in range(2)]
+            self.assertEqual(len(opened), 1)  # the first connection still had a slot
+            second = [await pool.acquire_channel() for _ in range(2)]
+            self.assertEqual([c.channels for c in pool.connections], [2, 2])
+            # both connections are full, the next caller waits for a release
+            waiting = asyncio.create_task(pool.acquire_channel())
+            await asyncio.sleep(0)
+            self.assertFalse(waiting.done())
+            await pool.release_channel(second[0])
+            third = await asyncio.wait_for(waiting, 5)
+            self.assertIs(pool.owners[third].connection, opened[1])
+            self.assertTrue(second[0].is_closed)
+            for channel in first + [second[1], third]:
+                await pool.release_channel(channel)
+            await pool.release_channel(None)
+            return pool
+
+        with patch("utils.rabbitmq.aio_pika.connect_robust", connect_robust):
+            pool = async_to_sync(run)()
+        self.assertEqual(len(opened), 2)
+        self.assertEqual([c.channels for c in pool.connections], [0, 0])
+        self.assertEqual(pool.owners, {})
+
+    def test_exchange_cache(self):
+        cache = ExchangeCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)  # b is the least recently used
+        self.assertEqual(list(cache.exchanges), ["a", "c"])
+        self.assertIsNone(cache.get("b"))
+
+        connection = FakeConnection()
+
+        async def run():
+            pooled = PooledConnection(connection, 100)
+            exchange = await pooled.get_exchange("user_1")
+            self.assertIs(await pooled.get_exchange("user_1"), exchange)
+            connection.reconnect()  # declared exchanges may be gone with the broker
+            self.assertEqual(len(pooled.exchanges), 0)
+            await pooled.get_exchange("user_1")
+            await pooled.publish_channel.close()
+            self.assertEqual(len(pooled.exchanges), 0)
+            await pooled.get_exchange("user_1")  # on a new publish channel
+
+        async_to_sync(run)()
+        self.assertEqual([e.name for e in connection.exchanges], ["user_1"] * 3)
+        self.assertEqual(len(connection.channels), 2)
+
+
+class FanOutTestCase(TestCase):
+    def test_retry_and_report(self):
+        published = []
+        attempts = Counter()
+        frames = []
+
+        async def publish(body, exchange_name):
+            attempts[exchange_name] += 1
+            if exchange_name == "user_3" or (
+                exchange_name == "user_2" and attempts[exchange_name] == 1
+            ):
+                raise ConnectionError("channel closed")
+            published.append(exchange_name)
+
+        async def send_message_to_front(message):
+            frames.append(message)
+
+        consumer = ChatConsumer()
+        consumer.fanout_concurrency = 2
+        consumer._publish = publish
+        consumer.send_message_to_front = send_message_to_front
+        message = Message(m_type=MessageType.FUNC_READ_MESSAGE, content="", sender=1)
+        async_to_sync(consumer.send_message_to_targets)(message, [1, 2, 3, 1])
+        # the failed publish to 2 is retried, 1 is not sent a third time
+        self.assertEqual(sorted(published), ["user_1", "user_1", "user_2"])
+        self.assertEqual(attempts["user_3"], 2)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].t_type, TargetType.ERROR)
+        self.assertEqual(frames[0].content, "cannot deliver to 3")
+        self.assertEqual(message.t_type, TargetType.OTHER)
+
+
+class FakeChannel:
+    async def basic_ack(self, delivery_tag):
+        pass
+
+
+class FakeDelivery:
+    # a rabbitmq delivery as ChatConsumer.callback sees it
+    channel = FakeChannel()
+    content_type = broker_codec.content_type
+
+    def __init__(self, delivery_tag: int, m_type: int = MessageType.TEXT):
+        self.delivery_tag = delivery_tag
+        self.body = encode_body(
+            Message(
+                message_id=delivery_tag, m_type=m_type, content="hi", sender=1, receiver=2, time=5
+            )
+        )
+        self.rejected = False
+
+    async def reject(self, requeue):
+        self.rejected = True
+
+
+class FlowControlTestCase(TestCase):
+    @override_settings(CHAT_PAUSE_BACKLOG=3, CHAT_RESUME_BACKLOG=1)
+    def test_pause_resume_and_exhausted_retries(self):
+        frames, deliveries = [], [FakeDelivery(tag) for tag in (1, 2, 3)]
+
+        class FakeQueue:
+            def __init__(self):
+                self.cancelled = []
+                self.consumed = 0
+
+            async def cancel(self, consumer_tag):
+                self.cancelled.append(consumer_tag)
+
+            async def consume(self, callback):
+                self.consumed += 1
+                return f"tag-{self.consumed}"
+
+        async def push_frame(frame):
+            frames.append(frame)
+
+        async def run():
+            loop = FakeLoop()
+            consumer = ChatConsumer()
+            consumer.retry, consumer.timeout = 2, 10
+            consumer.ack_manager = AckManager(AckScheduler(loop))
+            consumer.push_frame = push_frame
+            consumer.queue, consumer.consumer_tag = FakeQueue(), "tag-0"
+            for delivery in deliveries[:2]:
+                await consumer.callback(delivery)
+            self.assertEqual(consumer.consumer_tag, "tag-0")
+            await consumer.callback(deliveries[2])  # backlog reaches CHAT_PAUSE_BACKLOG
+            self.assertEqual(consumer.queue.cancelled, ["tag-0"])
+            self.assertIsNone(consumer.consumer_tag)
+            await consumer.ack_manager.acknowledge(1)
+            await consumer.update_flow()  # 2 is above CHAT_RESUME_BACKLOG
+            self.assertIsNone(consumer.consumer_tag)
+            # 2 and 3 are pushed again, then their retries are exhausted
+            for now in (10, 20):
+                loop.now = now
+                loop.tasks.clear()
+                consumer.ack_manager.scheduler._fire()
+                await asyncio.gather(*loop.tasks)
+            return consumer
+
+        consumer = async_to_sync(run)()
+        self.assertEqual(len(frames), 5)
+        self.assertEqual([d.delivery_tag for d in deliveries if d.rejected], [2, 3])
+        self.assertEqual(consumer.ack_manager.outstanding, set())
+        self.assertEqual(consumer.ack_manager.in_flight, 0)
+        self.assertEqual(consumer.consumer_tag, "tag-1")
+
+
+class CodecTestCase(TestCase):
+    def test_subprotocols(self):
+        self.assertIs(codec_for_subprotocols([]), JsonCodec)
+        self.assertIs(codec_for_subprotocols(["other"]), JsonCodec)
+        self.assertIs(codec_for_subprotocols(["other", "telethu.msgpack"]), MsgpackCodec)
+
+    def test_round_trip(self):
+        message = Message(message_id=1, content="hi", sender=2, receiver=3, time=5, who_read=[2])
+        for codec in (JsonCodec, MsgpackCodec):
+            self.assertEqual(codec.decode_message(codec.encode_model(message)), message)
+            frames = [codec.encode_model(message), codec.encode_model(message)]
+            self.assertEqual(
+                codec.loads(codec.encode_batch(frames)),
+                [message.model_dump(mode="json")] * 2,
+            )
+        self.assertEqual(MsgpackCodec.loads(MsgpackCodec.encode_batch([])), [])
+
+    def test_mixed_broker_and_socket(self):
+        message = Message(message_id=4, content=[1, "a"], sender=2, receiver=3, time=5)
+        json_body = JsonCodec.encode_model(message).encode()
+        msgpack_body = MsgpackCodec.encode_model(message)
+        # bodies without a content type come from older workers, they are json
+        self.assertEqual(decode_body(json_body, None), message)
+        self.assertEqual(decode_body(json_body, "application/json"), message)
+        self.assertEqual(decode_body(msgpack_body, "application/msgpack"), message)
+        for body, content_type in ((json_body, None), (msgpack_body, "application/msgpack")):
+            incoming = BrokerMessage(body, content_type)
+            for codec in (JsonCodec, MsgpackCodec):
+                self.assertEqual(codec.decode_message(incoming.frame(codec)), message)
+
+
+class BrokerMessageTestCase(TestCase):
+    def test_frame_forwards_body(self):
+        # not what encode_model would produce, so a re-encoded frame would differ
+        json_body = b'{"message_id": 7,  "content": "x", "m_type": 0}'
+        incoming = BrokerMessage(json_body, "application/json")
+        self.assertEqual((incoming.message_id, incoming.m_type), (7, MessageType.TEXT))
+        self.assertEqual(incoming.frame(JsonCodec), json_body.decode())
+        self.assertEqual(
+            MsgpackCodec.loads(incoming.frame(MsgpackCodec)),
+            {"message_id": 7, "content": "x", "m_type": 0},
+        )
+        msgpack_body = MsgpackCodec.dumps({"message_id": 8, "content": "y"})
+        incoming = BrokerMessage(msgpack_body, "application/msgpack")
+        self.assertIs(incoming.frame(MsgpackCodec), msgpack_body)
+        self.assertEqual(json.loads(incoming.frame(JsonCodec)), {"message_id": 8, "content": "y"})
+        self.assertIsNone(incoming._message)  # forwarding never builds the model
+
+    def test_message_only_for_cb_types(self):
+        built, dispatched = [], []
+        original = BrokerMessage.message
+
+        def message(incoming):
+            built.append(incoming.message_id)
+            return original(incoming)
+
+        async def dispatch(consumer, m_type, message):
+            dispatched.append(message)
+
+        async def push_frame(frame):
+            pass
+
+        async def run():
+            consumer = ChatConsumer()
+            consumer.ack_manager = AckManager(AckScheduler(FakeLoop()))
+            consumer.push_frame = push_frame
+            with patch.object(BrokerMessage, "message", message), patch.object(
+                consumer.cb, "dispatch", dispatch
+            ):
+                await consumer.callback(FakeDelivery(1))
+                await consumer.callback(FakeDelivery(2, MessageType.FUNC_ACCEPT_FRIEND))
+            # settle both, their callbacks are not left unawaited
+            for message_id in (1, 2):
+                await consumer.ack_manager.acknowledge(message_id)
+
+        async_to_sync(run)()
+        self.assertEqual(built, [2])
+        self.assertEqual([message.message_id for message in dispatched], [2])
+        self.assertEqual(BrokerMessage(FakeDelivery(3).body, broker_codec.content_type).message().content, "hi")
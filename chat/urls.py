@@ -8,4 +8,6 @@ urlpatterns = [
     re_path("history", views.chat_history, name="chat_history"),
     path("filter", views.filter_history, name="filter_history"),
     path("message/<int:message_id>", views.get_message, name="message"),
+    path("stats", views.handler_stats, name="handler_stats"),
+    path("unread", views.unread, name="unread"),
 ]
@@ -7,10 +7,18 @@ from django.views.decorators.csrf import csrf_exempt
 from users.models import MessageList, GroupList, User, Friendship
 from utils.data import Message, TargetType
 from utils.data import MessageStatusType
+from utils.handlers import handler_stats as get_handler_stats
+from utils.read_cursors import read_by, unread_counts
 from utils.utils_request import request_failed, request_success, BAD_METHOD
 
 
-def load_message(msg):
+def load_message(msg, who_read=None):
+    """
+    :param msg: a stored message
+    :param who_read: readers of the message, looked up from the read cursors if None
+    """
+    if who_read is None:
+        who_read = read_by([msg])[msg.message_id]
     try:
         info = json.loads(msg.info)
     except json.decoder.JSONDecodeError:
@@ -24,7 +32,7 @@ def load_message(msg):
         sender=msg.sender,
         receiver=msg.receiver,
         info=info,
-        who_read=[user.id for user in msg.who_read.all()],
+        who_read=who_read,
         who_reply=[message.message_id for message in msg.who_reply.all()],
         status=msg.status
     )
@@ -35,9 +43,10 @@ def load_message(msg):
 
 def load_message_from_list(msg_list):
     messages_list = []
+    readers = read_by(msg_list)
     for msg in msg_list:
         print("msg.content: ", msg.content)
-        loaded_message = load_message(msg)
+        loaded_message = load_message(msg, readers[msg.message_id])
         messages_list.append(loaded_message.model_dump())
     return messages_list
 
@@ -185,3 +194,21 @@ def get_message(request, message_id):
                 return request_failed(code=403, info="You are not the sender or receiver of this message! ")
     message_response = load_message(message)
     return request_success(message_response.model_dump())
+
+
+def handler_stats(request):
+    # counters of this worker process, scrape every worker to get the full picture
+    if request.user_id is None:
+        return request_failed(code=403, info="User id is not provided! ")
+    if request.method != "GET":
+        return BAD_METHOD
+    return request_success({"handlers": get_handler_stats()})
+
+
+def unread(request):
+    user_id = request.user_id
+    if user_id is None:
+        return request_failed(code=403, info="User id is not provided! ")
+    if request.method != "GET":
+        return BAD_METHOD
+    return request_success(unread_counts(int(user_id)))
@@ -6,5 +6,7 @@ python3 manage.py makemigrations
 echo "migrating database"
 python3 manage.py migrate
 rabbitmq-server -detached
+echo "starting storage workers"
+python3 manage.py run_storage &
 echo "starting server"
 python3 manage.py runserver 0.0.0.0:80
@@ -8,7 +8,6 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
-import threading
 
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
@@ -21,7 +20,6 @@ from channels.sessions import SessionMiddlewareStack
 from chat import consumers
 from django.urls import path  # Add this import
 
-from utils.storage import start_storage
 from utils.uid import globalIdMaker, globalMessageIdMaker
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "telethu.settings")
@@ -47,4 +45,3 @@ application = ProtocolTypeRouter(
 
 globalIdMaker.late_init()
 globalMessageIdMaker.late_init()
-threading.Thread(target=start_storage).start()
@@ -95,6 +95,39 @@ CHANNEL_LAYERS = {
     },
 }
 
+# rabbitmq
+RABBITMQ_URL = "amqp://localhost"
+RABBITMQ_POOL_SIZE = 4  # connections per worker process
+RABBITMQ_CHANNELS_PER_CONNECTION = 1024
+RABBITMQ_EXCHANGE_CACHE_SIZE = 4096  # declared exchanges cached per connection
+RABBITMQ_QUEUE_EXPIRES = 7 * 24 * 3600  # seconds an unused per-browser queue is kept by the broker
+RABBITMQ_QUEUE_MAX_LENGTH = 10000  # messages kept per browser queue, the oldest are dropped first
+CHAT_DEVICE_INACTIVE_DAYS = 7  # sweep_queues deletes queues of devices unseen for this long
+
+# chat
+CHAT_FANOUT_CONCURRENCY = 32  # concurrent publishes per fan-out
+CHAT_IDEMPOTENCY_BACKEND = "memory"  # "memory" or "redis" (uses CHANNEL_LAYERS host)
+CHAT_IDEMPOTENCY_MAX_SIZE = 100000  # entries, memory backend only
+CHAT_IDEMPOTENCY_TTL = 600  # seconds
+CHAT_COALESCE_DELAY = 0.01  # seconds a pushed message may wait for others (batch=1 clients)
+CHAT_COALESCE_MAX_ITEMS = 32  # messages per coalesced frame
+CHAT_READ_RECEIPT_DELAY = 0.5  # seconds read events are collected before a receipt is sent
+CHAT_READ_RECEIPT_MAX_ITEMS = 100  # read events handled at once
+CHAT_BROKER_CODEC = "json"  # "json" or "msgpack", encoding of rabbitmq bodies
+CHAT_DB_MEMO_TTL = 1.0  # seconds a shared db read (state of a group) is reused, 0 only merges concurrent reads
+CHAT_PRESENCE_BACKEND = "redis"  # "redis", "memory" (single worker only) or "none" (push to everyone)
+CHAT_PRESENCE_TTL = 90  # seconds a device stays online after its last heartbeat
+CHAT_PRESENCE_HEARTBEAT = 30  # seconds between heartbeats of an open socket, below CHAT_PRESENCE_TTL
+CHAT_PREFETCH = 64  # unacknowledged deliveries per socket (rabbitmq prefetch count)
+CHAT_PAUSE_BACKLOG = 48  # stop consuming when unacknowledged + buffered messages reach this
+CHAT_RESUME_BACKLOG = 16  # start consuming again when they drop to this
+
+# storage consumer (PermStore -> MessageList)
+STORAGE_BATCH_SIZE = 200  # messages written per transaction
+STORAGE_FLUSH_INTERVAL = 0.05  # seconds a partial batch may wait
+STORAGE_WORKERS = 1  # processes started by manage.py run_storage, sqlite allows a single writer
+STORAGE_REPORT_INTERVAL = 10  # seconds between throughput reports of a storage worker
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0017_loginmaillist_verification_time"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="grouplist",
+            name="version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.6 on 2026-10-18 13:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0018_grouplist_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Device",
+            fields=[
+                (
+                    "browser",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("last_seen", models.DateTimeField(auto_now=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="devices",
+                        to="users.user",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.6 on 2026-10-18 15:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_who_read(apps, schema_editor):
+    # the highest message each user has read in a conversation becomes its cursor
+    MessageList = apps.get_model("users", "MessageList")
+    ReadCursor = apps.get_model("users", "ReadCursor")
+    marks = {}
+    for user_id, message_id, t_type, sender, receiver in (
+        MessageList.who_read.through.objects.values_list(
+            "user_id",
+            "messagelist_id",
+            "messagelist__t_type",
+            "messagelist__sender",
+            "messagelist__receiver",
+        ).iterator()
+    ):
+        if t_type == 1:  # TargetType.GROUP
+            key = (user_id, 1, receiver)
+        else:
+            key = (user_id, 0, sender if receiver == user_id else receiver)
+        marks[key] = max(marks.get(key, 0), message_id)
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(user_id=user_id, t_type=t_type, target=target, last_read=last_read)
+            for (user_id, t_type, target), last_read in marks.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("users", "0019_device"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReadCursor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("t_type", models.IntegerField()),
+                ("target", models.IntegerField()),
+                ("last_read", models.IntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="read_cursors",
+                        to="users.user",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "t_type", "target")},
+            },
+        ),
+        migrations.RunPython(copy_who_read, migrations.RunPython.noop),
+    ]
@@ -91,6 +91,8 @@ class GroupList(models.Model):
     group_top_message = models.ManyToManyField(
         MessageList, related_name="group_top_message"
     )
+    # 成员/管理员/群主/群名每次变更加一，客户端据此发现漏掉的增量
+    version = models.IntegerField(default=0)
 
 class VerifyMailList(models.Model):
     # 等待验证的邮箱
@@ -110,4 +112,26 @@ class MaxId(models.Model):
     max_id_value = models.IntegerField()
 
     def __str__(self):
-        return str(self.max_id_value)
\ No newline at end of file
+        return str(self.max_id_value)
+
+class Device(models.Model):
+    # 一个浏览器（session 里的 browser）对应一个 rabbitmq 队列，长期不活跃的由 sweep_queues 清理
+    browser = models.CharField(max_length=64, primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="devices")
+    last_seen = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.browser
+
+class ReadCursor(models.Model):
+    # 已读水位线：user 在一个会话（好友或群）中读到的最大 message_id，取代逐条的 who_read
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_cursors")
+    t_type = models.IntegerField()  # TargetType.FRIEND or TargetType.GROUP
+    target = models.IntegerField()  # friend id or group id
+    last_read = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [["user", "t_type", "target"]]
+
+    def __str__(self):
+        return f"{self.user_id} -> {self.target}: {self.last_read}"
@@ -1,8 +1,11 @@
 import asyncio
 import dataclasses
-import time
+import heapq
+import inspect
+import itertools
+import weakref
 from enum import IntEnum, auto
-from typing import Any, Awaitable
+from typing import Any, Awaitable, Callable
 
 MessageId = int | str
 
@@ -15,18 +18,136 @@ class ManagingStatus(IntEnum):
     DONE = auto()
 
 
+@dataclasses.dataclass
+class Deadline:
+    callback: Callable[[], Awaitable] | None
+
+    def cancel(self):
+        # the heap entry stays until its time, it is skipped then
+        self.callback = None
+
+
 @dataclasses.dataclass
 class ManagingData:
     ack_callback: Awaitable
     rej_callback: Awaitable
     timeout: int
+    delivery_tag: int | None = None  # rabbitmq delivery tag of the message, if any
     status: ManagingStatus = ManagingStatus.PENDING
+    deadline: Deadline | None = None  # the timeout, cancelled once acknowledged
     lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
 
 
+def _close(awaitable: Awaitable):
+    # drop a callback that will never be awaited without a "never awaited" warning
+    if inspect.iscoroutine(awaitable):
+        awaitable.close()
+
+
+class AckScheduler:
+    """
+    deadline scheduler shared by every AckManager on the same event loop
+
+    deadlines live in a heap and a single timer handle is armed for the earliest
+    one, so waiting for an ack costs no task; a task is only spawned for a
+    deadline that expires without being cancelled
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.heap: list[tuple[float, int, Deadline]] = []
+        self.sequence = itertools.count()
+        self.handle: asyncio.TimerHandle | None = None
+        self.armed_at: float | None = None
+        self.tasks: set[asyncio.Task] = set()  # expired callbacks still running
+
+    def schedule(self, delay: float, callback: Callable[[], Awaitable]) -> Deadline:
+        """
+        :param delay: seconds from now
+        :param callback: coroutine function run when the deadline is reached
+        :return: the deadline, cancel it once the callback is not needed anymore
+        """
+        deadline = self.loop.time() + delay
+        entry = Deadline(callback)
+        heapq.heappush(self.heap, (deadline, next(self.sequence), entry))
+        if self.armed_at is None or deadline < self.armed_at:
+            self._arm(deadline)
+        return entry
+
+    def _arm(self, deadline: float):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.armed_at = deadline
+        self.handle = self.loop.call_at(deadline, self._fire)
+
+    def _fire(self):
+        self.handle = None
+        self.armed_at = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, entry = heapq.heappop(self.heap)
+            if entry.callback is None:
+                continue
+            task = self.loop.create_task(entry.callback())
+            self.tasks.add(task)
+            task.add_done_callback(self._finished)
+        if self.heap:
+            self._arm(self.heap[0][0])
+
+    def _finished(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        # nobody awaits an expired callback, do not lose its error
+        if not task.cancelled() and task.exception() is not None:
+            print(f"ack timeout failed: {str(task.exception())}")
+
+    def __len__(self):
+        # deadlines still waiting, cancelled ones excluded
+        return sum(entry.callback is not None for _, _, entry in self.heap)
+
+
+_schedulers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AckScheduler]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_scheduler() -> AckScheduler:
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = AckScheduler(loop)
+    return scheduler
+
+
 class AckManager:
-    def __init__(self):
+    def __init__(self, scheduler: AckScheduler | None = None):
+        """
+        :param scheduler: runs the timeouts, the scheduler of the running loop by default
+        """
+        self.scheduler = scheduler
         self.messages: dict[MessageId, ManagingData] = {}
+        # delivery tags received from rabbitmq and not acknowledged to it yet
+        self.outstanding: set[int] = set()
+        self.acked = 0
+        self.rejected = 0
+
+    def hold(self, delivery_tag: int):
+        """
+        record a delivery that is not acknowledged to rabbitmq yet
+
+        cumulative acknowledgements never go past a held tag
+        """
+        self.outstanding.add(delivery_tag)
+
+    def release(self, delivery_tag: int):
+        """
+        forget a held delivery that was settled without acknowledge, e.g. rejected
+        """
+        self.outstanding.discard(delivery_tag)
+
+    @property
+    def in_flight(self) -> int:
+        # deliveries received from rabbitmq and not settled yet
+        return len(self.outstanding)
 
     def manage(
         self,
@@ -34,6 +155,7 @@ class AckManager:
         ack_callback: Awaitable,
         rej_callback: Awaitable,
         timeout: int,
+        delivery_tag: int | None = None,
     ) -> bool:
         """
         manage a message
@@ -42,29 +164,38 @@ class AckManager:
         :param ack_callback: callback when message is acknowledged
         :param rej_callback: callback when message isn't acknowledged in time
         :param timeout: timeout in seconds
+        :param delivery_tag: rabbitmq delivery tag acknowledged by ack_callback
         :return: whether the message is successfully managed
 
         note: callbacks are assumed to be non-blocking
         """
-        self.messages[message_id] = ManagingData(
+        data = ManagingData(
             ack_callback=ack_callback,
             rej_callback=rej_callback,
             timeout=timeout,
+            delivery_tag=delivery_tag,
         )
+        self.messages[message_id] = data
 
         async def _timeout_hook():
-            print("callback registered")
-            await asyncio.sleep(timeout)
-            data = self.messages[message_id]
-            print("rejecting", data, message_id)
             async with data.lock:
-                if data.status == ManagingStatus.PENDING:
-                    data.status = ManagingStatus.REJECTING
+                if data.status != ManagingStatus.PENDING:
+                    return
+                data.status = ManagingStatus.REJECTING
+                try:
                     await data.rej_callback
-                    print(message_id, "rejected")
+                finally:
+                    # a failed rej_callback must not leave the entry behind
                     data.status = ManagingStatus.REJECTED
+                    self.rejected += 1
+                    # rej_callback may have managed the same id again for a retry
+                    if self.messages.get(message_id) is data:
+                        del self.messages[message_id]
+                        _close(data.ack_callback)
+                print(message_id, "rejected")
 
-        asyncio.create_task(_timeout_hook())
+        scheduler = self.scheduler if self.scheduler is not None else get_scheduler()
+        data.deadline = scheduler.schedule(timeout, _timeout_hook)
         return True
 
     async def acknowledge(self, message_id: MessageId) -> bool | Any:
@@ -77,22 +208,86 @@ class AckManager:
         if message_id not in self.messages:
             return False
         data = self.messages[message_id]
-        print("acknowledging", data, message_id)
         async with data.lock:
             if data.status != ManagingStatus.PENDING:
                 return False
-            data.status = ManagingStatus.CALLING
+            self._claim(data)
             ret = await data.ack_callback
-            data.status = ManagingStatus.DONE
-            print(message_id, "acknowledged")
+            self._done(message_id, data)
             return ret
 
+    async def acknowledge_batch(
+        self,
+        message_ids: list[MessageId],
+        up_to: int | None,
+        ack_multiple: Callable[[int], Awaitable],
+    ) -> int:
+        """
+        acknowledge many messages in one pass
+
+        :param message_ids: ids to acknowledge
+        :param up_to: also acknowledge every pending integer id not greater than this
+        :param ack_multiple: called with a delivery tag to acknowledge it and every
+            tag below it at once (rabbitmq ``basic_ack(multiple=True)``)
+        :return: number of messages acknowledged
+        """
+        ids = set(message_ids)
+        if up_to is not None:
+            ids.update(
+                message_id
+                for message_id in self.messages
+                if isinstance(message_id, int) and message_id <= up_to
+            )
+        batch: list[tuple[MessageId, ManagingData]] = []
+        for message_id in ids:
+            data = self.messages.get(message_id)
+            # status changes are synchronous, so claiming entries here cannot race
+            # with acknowledge() or a timeout, both re-check the status under the lock
+            if data is not None and data.status == ManagingStatus.PENDING:
+                self._claim(data)
+                batch.append((message_id, data))
+        tags = {data.delivery_tag for _, data in batch if data.delivery_tag is not None}
+        # one cumulative ack covers the batch tags below the lowest tag still in flight
+        lowest_other = min(self.outstanding - tags, default=None)
+        covered = {
+            tag for tag in tags if lowest_other is None or tag < lowest_other
+        }
+        if covered:
+            await ack_multiple(max(covered))
+        for message_id, data in batch:
+            if data.delivery_tag in covered:
+                _close(data.ack_callback)
+            else:
+                await data.ack_callback
+            self._done(message_id, data)
+        return len(batch)
+
+    @staticmethod
+    def _claim(data: ManagingData):
+        data.status = ManagingStatus.CALLING
+        _close(data.rej_callback)
+        if data.deadline is not None:
+            data.deadline.cancel()  # acknowledged, the timeout never needs a task
+
+    def _done(self, message_id: MessageId, data: ManagingData):
+        data.status = ManagingStatus.DONE
+        self.acked += 1
+        self.outstanding.discard(data.delivery_tag)
+        if self.messages.get(message_id) is data:
+            del self.messages[message_id]
+
+    @property
+    def pending(self) -> int:
+        return sum(
+            data.status == ManagingStatus.PENDING for data in self.messages.values()
+        )
+
     def status_of(self, message_id: MessageId) -> ManagingStatus:
         """
         get status of a message
 
         :param message_id: message id
-        :return: status of the message
+        :return: status of the message, finished messages are pruned and raise KeyError
         """
         return self.messages[message_id].status
 
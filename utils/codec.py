@@ -0,0 +1,141 @@
+import json
+from typing import Any
+
+import msgpack
+from django.conf import settings
+from pydantic import BaseModel, TypeAdapter
+
+from utils.data import Message, MessageType
+
+
+class JsonCodec:
+    name = "json"
+    subprotocol = None  # default, no Sec-WebSocket-Protocol needed
+    content_type = "application/json"
+
+    @staticmethod
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj)
+
+    @staticmethod
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+    @staticmethod
+    def encode_model(model: BaseModel) -> str:
+        return model.model_dump_json()
+
+    @staticmethod
+    def encode_batch(items: list[str]) -> str:
+        # items are already encoded, join them instead of encoding a list again
+        return "[" + ",".join(items) + "]"
+
+    @staticmethod
+    def decode_message(data: str | bytes) -> Message:
+        return Message.model_validate_json(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    subprotocol = "telethu.msgpack"
+    content_type = "application/msgpack"
+
+    @staticmethod
+    def dumps(obj: Any) -> bytes:
+        return msgpack.packb(obj)
+
+    @staticmethod
+    def loads(data: bytes) -> Any:
+        return msgpack.unpackb(data, strict_map_key=False)
+
+    @staticmethod
+    def encode_model(model: BaseModel) -> bytes:
+        return msgpack.packb(model.model_dump(mode="json"))
+
+    @staticmethod
+    def encode_batch(items: list[bytes]) -> bytes:
+        return msgpack.Packer().pack_array_header(len(items)) + b"".join(items)
+
+    @classmethod
+    def decode_message(cls, data: bytes) -> Message:
+        return Message.model_validate(cls.loads(data))
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
+
+
+def codec_for_subprotocols(subprotocols: list[str]):
+    """
+    pick the websocket codec offered by the client, json if none matches
+    """
+    for codec in CODECS.values():
+        if codec.subprotocol is not None and codec.subprotocol in subprotocols:
+            return codec
+    return JsonCodec
+
+
+def codec_for_content_type(content_type: str | None):
+    """
+    pick the codec of a rabbitmq body, bodies without content type are json
+    """
+    for codec in CODECS.values():
+        if codec.content_type == content_type:
+            return codec
+    return JsonCodec
+
+
+# codec used for bodies published to rabbitmq
+broker_codec = CODECS[settings.CHAT_BROKER_CODEC]
+
+
+def encode_body(model: BaseModel) -> bytes:
+    """
+    encode a model as a rabbitmq body with the broker codec
+    """
+    data = broker_codec.encode_model(model)
+    return data.encode() if isinstance(data, str) else data
+
+
+def decode_body(body: bytes, content_type: str | None) -> Message:
+    return codec_for_content_type(content_type).decode_message(body)
+
+
+# shared validator for broker messages that do need to become a Message
+MESSAGE_ADAPTER = TypeAdapter(Message)
+
+
+class BrokerMessage:
+    """
+    message delivered by rabbitmq, decoded lazily
+
+    bodies on our exchanges were produced by encode_body, so they are trusted: the
+    common path only reads the raw fields it needs and forwards the body as is,
+    the pydantic model is built (and validated) only when a handler asks for it
+    """
+
+    def __init__(self, body: bytes, content_type: str | None):
+        self.body = body
+        self.codec = codec_for_content_type(content_type)
+        self.data: dict = self.codec.loads(body)
+        self._message: Message | None = None
+
+    @property
+    def message_id(self) -> int | str | None:
+        return self.data.get("message_id")
+
+    @property
+    def m_type(self) -> int:
+        return self.data.get("m_type", MessageType.TEXT)
+
+    def message(self) -> Message:
+        if self._message is None:
+            self._message = MESSAGE_ADAPTER.validate_python(self.data)
+        return self._message
+
+    def frame(self, codec) -> str | bytes:
+        """
+        the message as a websocket frame of the given codec
+        """
+        if codec is self.codec:
+            return self.body.decode() if codec is JsonCodec else self.body
+        return codec.dumps(self.data)
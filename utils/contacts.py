@@ -0,0 +1,143 @@
+from utils.data import ContactsDelta
+from utils.membership import GroupMembershipCache
+
+
+class ContactState:
+    """
+    friends and groups of a connected user, indexed for O(1) lookups
+
+    the containers are long-lived and updated in place; the state of each group
+    (members, admins, ...) is not copied here but referenced in the process wide
+    GroupMembershipCache, call clear() to release it
+    """
+
+    def __init__(self, cache: GroupMembershipCache):
+        """
+        :param cache: where the state of the groups is kept, shared by the consumers
+            of a process
+        """
+        self.cache = cache
+        self.friends: set[int] = set()
+        self.groups: set[int] = set()
+
+    def set_friends(self, friend_ids):
+        """
+        :param friend_ids: ids returned by db_query_friends
+        """
+        self.friends.clear()
+        self.friends.update(friend_ids)
+
+    def set_groups(self, group_ids, members, names, owners, admins, versions):
+        """
+        replace group state with the result of db_query_group
+        """
+        group_ids = set(group_ids)
+        for group_id in self.groups - group_ids:
+            self.drop_group(group_id)
+        for group_id in group_ids:
+            self._set_group(
+                group_id,
+                (
+                    members.get(group_id, ()),
+                    names.get(group_id),
+                    owners.get(group_id),
+                    admins.get(group_id, ()),
+                    versions.get(group_id, 0),
+                ),
+            )
+
+    def set_group(self, group_id: int, state, user_id: int):
+        """
+        replace one group with the result of db_query_group_state
+
+        :param group_id: group id
+        :param state: (members, name, owner, admins, version), None if the group is gone
+        :param user_id: user owning this state, the group is dropped if they left it
+        """
+        if state is None or user_id not in state[0]:
+            if state is not None and group_id in self.groups:
+                self.cache.put(group_id, state)  # still fresh for the other holders
+            self.drop_group(group_id)
+            return
+        self._set_group(group_id, state)
+
+    def _set_group(self, group_id: int, state):
+        if group_id in self.groups:
+            self.cache.put(group_id, state)
+        else:
+            self.groups.add(group_id)
+            self.cache.hold(group_id, state)
+
+    def drop_group(self, group_id: int):
+        if group_id in self.groups:
+            self.groups.discard(group_id)
+            self.cache.release(group_id)
+
+    def clear(self):
+        for group_id in list(self.groups):
+            self.drop_group(group_id)
+        self.friends.clear()
+
+    def members_of(self, group_id: int) -> frozenset[int]:
+        entry = self.cache.get(group_id) if group_id in self.groups else None
+        return entry.members if entry is not None else frozenset()
+
+    def version_of(self, group_id: int) -> int:
+        entry = self.cache.get(group_id) if group_id in self.groups else None
+        return entry.version if entry is not None else 0
+
+    def apply_friends(self, delta: ContactsDelta, user_id: int):
+        """
+        apply the absolute state of a friendship, only state 1 makes two users friends
+        """
+        if user_id not in delta.friends:
+            return
+        for friend_id in delta.friends:
+            if friend_id == user_id:
+                continue
+            if delta.friendship == 1:
+                self.friends.add(friend_id)
+            else:
+                self.friends.discard(friend_id)
+
+    def apply_group(self, delta: ContactsDelta, user_id: int) -> bool:
+        """
+        apply a group delta
+
+        :param delta: delta of the group
+        :param user_id: user owning this state
+        :return: False if a version gap was found and the group must be reloaded
+        """
+        group_id = delta.group_id
+        if delta.deleted:
+            self.drop_group(group_id)
+            return True
+        if delta.snapshot:
+            if user_id in delta.added_members:
+                self._set_group(
+                    group_id,
+                    (
+                        delta.added_members,
+                        delta.name,
+                        delta.owner,
+                        delta.added_admins,
+                        delta.version or 0,
+                    ),
+                )
+            return True
+        if group_id not in self.groups:
+            # joined a group we know nothing about yet
+            return user_id not in delta.added_members
+        # the shared entry is updated first, other consumers still reference it
+        applied = self.cache.apply(delta)
+        if user_id in delta.removed_members:
+            self.drop_group(group_id)
+            return True
+        return applied
+
+    def is_group(self, target_id: int) -> bool:
+        return target_id in self.groups
+
+    def __contains__(self, target_id: int):
+        # whether the user may talk to target_id, a friend or a joined group
+        return target_id in self.friends or target_id in self.groups
@@ -77,6 +77,29 @@ class MessageStatusType(IntFlag):
     EDITED = auto()
 
 
+class ContactsDelta(BaseModel):
+    """
+    change of friends or groups carried by a function message
+
+    receivers apply it to their cached contacts, a group delta whose version is not
+    exactly the next one makes them reload that group; an empty delta means nothing
+    changed, and function messages without delta make receivers reload everything
+    """
+
+    group_id: int | None = None
+    version: int | None = None  # group version after the change
+    snapshot: bool = False  # a new group, the fields below describe it completely
+    deleted: bool = False
+    name: str | None = None
+    owner: int | None = None
+    added_members: list[int] = []
+    removed_members: list[int] = []
+    added_admins: list[int] = []
+    removed_admins: list[int] = []
+    friends: list[int] = []  # both users of a friendship
+    friendship: int | None = None  # Friendship.state after the change
+
+
 class Message(BaseModel):
     message_id: int | str = None  # str if id is temporary
     m_type: MessageType = MessageType.TEXT
@@ -93,6 +116,7 @@ class Message(BaseModel):
     who_read: list | None = []  # list for group chat, bool for personal chat
     who_reply: list[int] | None = None  # list for group chat, bool for personal chat
     status: MessageStatusType | None = MessageStatusType.NORMAL
+    delta: ContactsDelta | None = None  # written by backend for contact changes
 
 
 class Ack(BaseModel):
@@ -100,6 +124,11 @@ class Ack(BaseModel):
     reference: str | None = None  # temporary id
 
 
+class BatchAck(BaseModel):
+    message_ids: list[int] = []  # acknowledge these ids
+    up_to: int | None = None  # and every pushed id not greater than this
+
+
 class FriendType(enum.IntEnum):
     user_equal_friend = 0
     already_friend = 1
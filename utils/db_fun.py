@@ -1,19 +1,41 @@
 import json
 import time
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import F
 
 from files.models import Multimedia
-from users.models import Friendship, GroupList, User, MessageList
+from users.models import Device, Friendship, GroupList, User, MessageList
 from utils.data import MessageStatusType
+from utils.read_cursors import advance_read_cursors, conversation_of
 from utils.data import (
     TargetType,
     UserData,
     GroupData,
     FriendType,
 )
+from utils.singleflight import singleflight
 from utils.uid import globalIdMaker
 
 
+def _bump_version(group: GroupList, *fields: str) -> int:
+    """
+    save changed fields of a group and increase its version
+
+    the increment runs in the database so concurrent changes never share a version,
+    and version is never written back from a possibly stale instance
+
+    :param group: group that has been changed
+    :param fields: concrete fields to save, many-to-many changes are already saved
+    :return: new version
+    """
+    if fields:
+        group.save(update_fields=fields)
+    GroupList.objects.filter(group_id=group.group_id).update(version=F("version") + 1)
+    group.refresh_from_db(fields=["version"])
+    return group.version
+
+
 @database_sync_to_async
 def db_query_group_info(group_id_list) -> dict[int, GroupData]:
     group_info = {}
@@ -38,6 +60,7 @@ def db_query_group_info(group_id_list) -> dict[int, GroupData]:
     return group_info
 
 
+@singleflight()
 @database_sync_to_async
 def db_query_friends(user_id,if_include_block=False):
     friends = Friendship.objects.filter(user1=user_id)
@@ -73,6 +96,7 @@ def db_query_friends_info(friends_id) -> dict[int, UserData]:
     return friends_info
 
 
+@singleflight()
 @database_sync_to_async
 def db_query_group(self_user_id):
     # 这个方法执行同步数据库查询
@@ -82,6 +106,7 @@ def db_query_group(self_user_id):
     group_members = {}
     group_owner = {}
     group_admin = {}
+    group_versions = {}
     for group in groups:
         group_id.append(int(group.group_id))
         group_members_user = group.group_members.all()
@@ -95,7 +120,31 @@ def db_query_group(self_user_id):
         group_admin[group.group_id] = []
         for admin in group.group_admin.all():
             group_admin[group.group_id].append(admin.id)
-    return group_id, group_members, group_names, group_owner, group_admin
+        group_versions[group.group_id] = group.version
+    return group_id, group_members, group_names, group_owner, group_admin, group_versions
+
+
+@singleflight(ttl=settings.CHAT_DB_MEMO_TTL)
+@database_sync_to_async
+def db_query_group_state(group_id):
+    """
+    state of one group, the same for every member so concurrent loads share one query
+
+    :return: (members, name, owner, admins, version), None if the group does not exist
+    """
+    group = GroupList.objects.filter(group_id=group_id).first()
+    if group is None:
+        return None
+    members = frozenset(member.id for member in group.group_members.all())
+    admins = frozenset(admin.id for admin in group.group_admin.all())
+    owner = group.group_owner.id if group.group_owner is not None else None
+    return members, group.group_name, owner, admins, group.version
+
+
+@database_sync_to_async
+def db_touch_device(browser, user_id):
+    # 记录设备最近一次连接/断开的时间
+    Device.objects.update_or_create(browser=browser, defaults={"user_id": user_id})
 
 
 @database_sync_to_async
@@ -206,7 +255,6 @@ def db_add_member(group_id, add_members, self_user_id):
             if member_id not in group.group_candidate_members.all():
                 group.group_candidate_members.add(member_id)
             candidate_add_list.append(member_id)
-    group.save()
     if len(real_add_list) == 0 and len(candidate_add_list) == 0:
         print(f"real_list: {real_add_list}, candidate_add_list: {candidate_add_list}")
         raise KeyError("no one can be added")
@@ -218,7 +266,8 @@ def db_add_member(group_id, add_members, self_user_id):
         id_list.append(group.group_owner.id)
         for member_id in group.group_admin.all():
             id_list.append(member_id.id)
-    return real_add_list, candidate_add_list, id_list
+    version = _bump_version(group) if len(real_add_list) != 0 else group.version
+    return real_add_list, candidate_add_list, id_list, version
 
 
 @database_sync_to_async
@@ -233,7 +282,6 @@ def db_reject_candidate(group_id: int, rejected_member: int, self_user_id: int):
     if not group.group_candidate_members.filter(id=rejected_member).exists():
         raise KeyError("Not a candidate")
     group.group_candidate_members.remove(rejected_member)
-    group.save()
     id_list = [group.group_owner.id]
     for member in group.group_admin.all():
         id_list.append(member.id)
@@ -255,8 +303,7 @@ def db_change_group_owner(group_id, old_owner, new_owner):
     if user not in group.group_members.all():
         raise KeyError("new owner not in group")
     group.group_owner = user
-    group.save()
-    return group.group_id
+    return _bump_version(group, "group_owner")
 
 
 @database_sync_to_async
@@ -390,8 +437,7 @@ def db_add_or_remove_admin(group_id, admin_id, user_id, if_add):
         if user not in group.group_admin.all():
             raise KeyError("not admin")
         group.group_admin.remove(user)
-    group.save()
-    return True
+    return _bump_version(group)
 
 
 @database_sync_to_async
@@ -418,8 +464,7 @@ def db_group_remove_member(group_id, remove_id, user_id):
     group.group_members.remove(user)
     if user in group.group_admin.all():
         group.group_admin.remove(user)
-    group.save()
-    return True
+    return _bump_version(group)
 
 
 @database_sync_to_async
@@ -447,21 +492,42 @@ def db_add_or_del_top_message(group_id, message_id, user_id, if_add):
         if message not in group.group_top_message.all():
             raise KeyError("message not top")
         group.group_top_message.remove(message)
-    group.save()
     return True
 
 
 @database_sync_to_async
-def db_add_read_message(available_list, message_id, user_id):
-    message = MessageList.objects.filter(message_id=message_id).first()
-    if message is None:
-        raise KeyError("message not exist")
-    if message.receiver != user_id and message.receiver not in available_list:
-        raise KeyError("you cannot read this message")
-    else:
-        message.who_read.add(user_id)
-        message.save()
-        return message.sender, message.receiver, message.t_type
+def db_read_messages(available_list, message_ids, user_id):
+    """
+    mark messages read, with one cursor update for all their conversations
+
+    :param available_list: friends and groups of the reader
+    :param message_ids: ids of the messages read
+    :param user_id: reader
+    :return: (receipts, errors); a receipt per conversation is (latest message read,
+        senders of the messages read), errors are messages that cannot be read by id
+    """
+    messages = MessageList.objects.only("message_id", "sender", "receiver", "t_type").in_bulk(
+        message_ids
+    )
+    errors: dict[int, str] = {}
+    latest: dict[tuple[int, int], MessageList] = {}
+    senders: dict[tuple[int, int], set[int]] = {}
+    for message_id in message_ids:
+        message = messages.get(message_id)
+        if message is None:
+            errors[message_id] = "message not exist"
+            continue
+        if message.receiver != user_id and message.receiver not in available_list:
+            errors[message_id] = "you cannot read this message"
+            continue
+        key = conversation_of(message, user_id)
+        if key not in latest or latest[key].message_id < message_id:
+            latest[key] = message
+        senders.setdefault(key, set()).add(message.sender)
+    advance_read_cursors(
+        user_id, {key: message.message_id for key, message in latest.items()}
+    )
+    return [(message, senders[key]) for key, message in latest.items()], errors
 
 
 @database_sync_to_async
@@ -477,9 +543,9 @@ def db_reduce_person(group_id, person_id):
     if person_id == group.group_owner.id:
         raise KeyError("owner can not be reduced")
     group.group_members.remove(person_id)
-    group.save()
+    group.group_admin.remove(person_id)
     group_list = [members.id for members in group.group_members.all()]
-    return group_list
+    return group_list, _bump_version(group)
 
 
 @database_sync_to_async
@@ -667,9 +733,9 @@ def db_change_group_name(group_id, group_name, user_id):
     if group.group_owner.id != user_id and user_self not in group.group_admin.all():
         raise KeyError("you are not the owner or admin")
     group.group_name = group_name
-    group.save()
+    version = _bump_version(group, "group_name")
     group_list = [members.id for members in group.group_members.all()]
-    return group_list
+    return group_list, version
 
 
 @database_sync_to_async
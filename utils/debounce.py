@@ -0,0 +1,87 @@
+import asyncio
+
+
+class DebouncedBuffer:
+    """
+    holds pushed items for at most ``delay`` seconds or until ``max_items`` are
+    held, then hands them to ``handle`` together
+
+    subclasses decide how an item is stored (``new_items`` and ``store``) and what
+    is done with a batch (``handle``)
+    """
+
+    def __init__(self, delay: float, max_items: int):
+        """
+        :param delay: seconds an item may wait for others
+        :param max_items: items handed over at once
+        """
+        self.delay = delay
+        self.max_items = max_items
+        self.items = self.new_items()
+        self.timer: asyncio.Task | None = None  # sleeping until the next flush
+        self.tasks: set[asyncio.Task] = set()  # timers, including those flushing
+        self.closed = False
+
+    def new_items(self):
+        return []
+
+    def store(self, *args):
+        raise NotImplementedError
+
+    async def handle(self, items):
+        raise NotImplementedError
+
+    async def push(self, *args):
+        """
+        store an item, the arguments are those of ``store``; ignored once closed
+        """
+        if self.closed:
+            return
+        self.store(*args)
+        if len(self.items) >= self.max_items:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().create_task(self._flush_later())
+            self.tasks.add(self.timer)
+            self.timer.add_done_callback(self.tasks.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self.timer = None  # items pushed while flushing start a new timer
+        try:
+            await self.flush()
+        except Exception as e:
+            # nobody awaits this task, do not lose the error
+            print(f"{type(self).__name__} cannot flush: {str(e)}")
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.items:
+            return
+        items, self.items = self.items, self.new_items()
+        await self.handle(items)
+
+    async def close(self):
+        """
+        flush what is left and wait for flushes started by the timer, nothing is
+        collected afterwards
+        """
+        self.closed = True
+        await self.flush()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    def discard(self):
+        """
+        drop what is left and stop the timers, nothing is collected afterwards
+        """
+        self.closed = True
+        for task in self.tasks:
+            task.cancel()
+        self.timer = None
+        self.items = self.new_items()
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,123 @@
+import bisect
+import time
+from typing import Any, Awaitable, Callable
+
+# upper bounds of latency histogram buckets in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+Handler = Callable[[Any, Any], Awaitable]
+# middleware(consumer, message, call_next) -> awaitable, call_next() runs the rest of the chain
+Middleware = Callable[[Any, Any, Callable[[], Awaitable]], Awaitable]
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed: float, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.total_time += elapsed
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_time": self.total_time,
+            "buckets": dict(
+                zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], self.histogram)
+            ),
+        }
+
+
+class HandlerRegistry:
+    """
+    maps message types to consumer handlers, built once when the class is defined
+
+    every dispatch is timed and counted per handler, see handler_stats(); handlers
+    are told apart by qualified name, registry names must be unique
+    """
+
+    def __init__(self, name: str):
+        if name in registries:
+            raise ValueError(f"handler registry {name} already exists")
+        self.name = name
+        self.handlers: dict[int, Handler] = {}
+        self.default: Handler | None = None
+        self.middlewares: list[Middleware] = []
+        self.stats: dict[str, HandlerStats] = {}
+        registries[name] = self
+
+    def on(self, *m_types: int):
+        """
+        register the decorated handler for the given message types
+        """
+
+        def decorator(func: Handler) -> Handler:
+            for m_type in m_types:
+                self.handlers[m_type] = func
+            self.stats.setdefault(func.__qualname__, HandlerStats())
+            return func
+
+        return decorator
+
+    def fallback(self, func: Handler) -> Handler:
+        """
+        register the decorated handler for message types without their own handler
+        """
+        self.default = func
+        self.stats.setdefault(func.__qualname__, HandlerStats())
+        return func
+
+    def use(self, middleware: Middleware) -> Middleware:
+        self.middlewares.append(middleware)
+        return middleware
+
+    def __contains__(self, m_type: int):
+        return m_type in self.handlers or self.default is not None
+
+    async def dispatch(self, consumer, m_type: int, message) -> Any:
+        """
+        run the handler of m_type through the middlewares
+
+        :param consumer: instance the handler is bound to
+        :param m_type: message type
+        :param message: argument passed to the handler
+        :return: return value of the handler, None if no handler matches
+        """
+        func = self.handlers.get(m_type, self.default)
+        if func is None:
+            return None
+
+        async def call(index: int = 0):
+            if index == len(self.middlewares):
+                return await func(consumer, message)
+            return await self.middlewares[index](
+                consumer, message, lambda: call(index + 1)
+            )
+
+        failed = True
+        start = time.perf_counter()
+        try:
+            ret = await call()
+            failed = False
+            return ret
+        finally:
+            self.stats[func.__qualname__].record(time.perf_counter() - start, failed)
+
+
+registries: dict[str, HandlerRegistry] = {}
+
+
+def handler_stats() -> dict:
+    """
+    call counts, error counts and latency histograms of every registered handler
+    """
+    return {
+        name: {handler: stats.as_dict() for handler, stats in registry.stats.items()}
+        for name, registry in registries.items()
+    }
@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # redis comes with channels-redis, but keep the memory store usable without it
+    redis = None
+
+
+class MemoryIdempotencyStore:
+    """
+    remembers which real message id was given to a client's temporary id
+
+    temporary ids are only unique per browser, so entries are keyed by user and
+    browser; a retry reconnecting from the same browser is still recognised.
+    bounded both by size (oldest entries are evicted first) and by time
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl  # seconds
+        self.entries: OrderedDict[tuple[int, str, str], tuple[int, float]] = OrderedDict()
+
+    async def claim(self, user_id: int, device: str, tmp_id, message_id: int) -> int | None:
+        """
+        give a temporary id its real message id unless it already has one
+
+        :param user_id: sender
+        :param device: browser of the sender
+        :param tmp_id: temporary id chosen by the client
+        :param message_id: real id for the message if it is new
+        :return: None if the message is new, else the real id it was given before
+        """
+        key = (user_id, device, str(tmp_id))
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] >= time.monotonic():
+            return entry[0]
+        # nothing is awaited between the lookup and the insert, so this is atomic
+        self.entries[key] = (message_id, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        self._evict()
+        return None
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.entries:
+            key, (_, expire_at) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_size and expire_at >= now:
+                break
+            del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisIdempotencyStore:
+    """
+    same as MemoryIdempotencyStore but kept in redis, so a client reconnecting to
+    another worker is still deduplicated
+    """
+
+    def __init__(self, host: str, port: int, ttl: int):
+        self.host = host
+        self.port = port
+        self.ttl = ttl  # seconds
+        self.client = None
+
+    @staticmethod
+    def _key(user_id: int, device: str, tmp_id) -> str:
+        return f"idempotency:{user_id}:{device}:{tmp_id}"
+
+    def _client(self):
+        if self.client is None:
+            self.client = redis.Redis(host=self.host, port=self.port)
+        return self.client
+
+    async def claim(self, user_id: int, device: str, tmp_id, message_id: int) -> int | None:
+        key = self._key(user_id, device, tmp_id)
+        try:
+            # one SET NX decides which of concurrent senders owns the temporary id
+            if await self._client().set(key, message_id, ex=self.ttl, nx=True):
+                return None
+            stored = await self._client().get(key)
+        except Exception as e:
+            print(f"idempotency store unavailable: {str(e)}")
+            return None
+        # expired between the two calls, too old to be a retry
+        return None if stored is None else int(stored)
+
+
+def make_idempotency_store():
+    if settings.CHAT_IDEMPOTENCY_BACKEND == "redis" and redis is not None:
+        host, port = settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"][0]
+        return RedisIdempotencyStore(host, port, settings.CHAT_IDEMPOTENCY_TTL)
+    return MemoryIdempotencyStore(
+        settings.CHAT_IDEMPOTENCY_MAX_SIZE, settings.CHAT_IDEMPOTENCY_TTL
+    )
+
+
+globalIdempotencyStore = make_idempotency_store()
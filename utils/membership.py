@@ -0,0 +1,173 @@
+import asyncio
+import json
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage
+
+from utils.db_fun import db_query_group_state
+from utils.rabbitmq import RabbitMQPool, globalRabbitMQPool
+
+
+class GroupEntry:
+    __slots__ = ("members", "admins", "name", "owner", "version", "refs", "stale")
+
+    def __init__(self, members, name, owner, admins, version: int):
+        self.members: frozenset[int] = frozenset(members)
+        self.admins: frozenset[int] = frozenset(admins)
+        self.name: str | None = name
+        self.owner: int | None = owner
+        self.version = version
+        self.refs = 0
+        self.stale = False  # a newer version was announced but could not be loaded
+
+
+class GroupMembershipCache:
+    """
+    group state shared by every consumer of this worker process
+
+    an entry lives as long as a consumer of one of its members holds a reference,
+    so a large group is stored once per process instead of once per socket. any
+    node changing a group announces the new version on the ``group_membership``
+    fanout exchange, entries older than an announced version are reloaded
+    """
+
+    EXCHANGE = "group_membership"
+
+    def __init__(self, pool: RabbitMQPool):
+        self.pool = pool
+        self.entries: dict[int, GroupEntry] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.channel: AbstractChannel | None = None
+
+    def hold(self, group_id: int, state):
+        """
+        take a reference on a group and store its state if newer than the cached one
+
+        :param group_id: group id
+        :param state: (members, name, owner, admins, version)
+        """
+        self.put(group_id, state)
+        self.entries[group_id].refs += 1
+
+    def release(self, group_id: int):
+        entry = self.entries.get(group_id)
+        if entry is None:
+            return
+        entry.refs -= 1
+        if entry.refs <= 0:
+            del self.entries[group_id]
+
+    def put(self, group_id: int, state):
+        """
+        store a group state loaded from the database unless the cached one is newer
+        """
+        entry = self.entries.get(group_id)
+        if entry is not None and entry.version > state[4]:
+            return
+        new_entry = GroupEntry(*state)
+        if entry is not None:
+            new_entry.refs = entry.refs
+        self.entries[group_id] = new_entry
+
+    def get(self, group_id: int) -> GroupEntry | None:
+        return self.entries.get(group_id)
+
+    def apply(self, delta) -> bool:
+        """
+        apply a ContactsDelta once for the whole process
+
+        :return: False if a version gap was found and the group must be reloaded
+        """
+        entry = self.entries.get(delta.group_id)
+        if entry is None or entry.stale:
+            return False
+        if delta.version is None or delta.version <= entry.version:
+            return True  # no change, or applied by another consumer already
+        if delta.version != entry.version + 1:
+            return False
+        if delta.added_members or delta.removed_members:
+            entry.members = entry.members.union(delta.added_members).difference(
+                delta.removed_members
+            )
+        if delta.added_admins or delta.removed_admins or delta.removed_members:
+            entry.admins = (
+                entry.admins.union(delta.added_admins)
+                .difference(delta.removed_admins)
+                .difference(delta.removed_members)
+            )
+        if delta.owner is not None:
+            entry.owner = delta.owner
+        if delta.name is not None:
+            entry.name = delta.name
+        entry.version = delta.version
+        return True
+
+    async def start(self):
+        """
+        listen to announcements on this event loop, called by every consumer
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.entries.clear()  # entries of a previous loop are not maintained anymore
+        try:
+            self.channel = await self.pool.acquire_channel()
+            exchange = await self.channel.declare_exchange(self.EXCHANGE, type="fanout")
+            queue = await self.channel.declare_queue(exclusive=True)
+            await queue.bind(exchange)
+            await queue.consume(self._on_announce, no_ack=True)
+        except Exception:
+            self.loop = None
+            raise
+
+    async def announce(self, channel: AbstractChannel, group_id: int, version: int | None):
+        """
+        tell every node that a group changed
+
+        :param channel: channel borrowed by the caller
+        :param group_id: group id
+        :param version: new version of the group, None if it was deleted
+        """
+        exchange = await self.pool.get_exchange(channel, self.EXCHANGE)
+        await exchange.publish(
+            aio_pika.Message(
+                body=json.dumps({"group_id": group_id, "version": version}).encode(),
+                content_type="application/json",
+            ),
+            routing_key="",
+        )
+
+    async def _on_announce(self, message: AbstractIncomingMessage):
+        try:
+            data = json.loads(message.body)
+            group_id, version = data["group_id"], data["version"]
+        except Exception as e:
+            print(f"cannot read group announcement {message.body[:64]!r}: {str(e)}")
+            return
+        entry = self.entries.get(group_id)
+        if entry is None or version is None:
+            # deletions reach every member consumer, they release the entry
+            return
+        if entry.version >= version and not entry.stale:
+            return
+        try:
+            state = await db_query_group_state(group_id)
+            if state is not None and state[4] < version:
+                db_query_group_state.forget(group_id)
+                state = await db_query_group_state(group_id)
+        except Exception as e:
+            print(f"cannot reload group {group_id}: {str(e)}")
+            # consumers hold the entry, so it is kept but the next delta reloads it
+            entry = self.entries.get(group_id)
+            if entry is not None:
+                entry.stale = True
+            return
+        if state is not None and group_id in self.entries:
+            self.put(group_id, state)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+globalMembershipCache = GroupMembershipCache(globalRabbitMQPool)
@@ -0,0 +1,34 @@
+from typing import Awaitable, Callable
+
+from utils.debounce import DebouncedBuffer
+
+Frame = str | bytes
+
+
+class OutboundBuffer(DebouncedBuffer):
+    """
+    coalesces outbound websocket frames
+
+    frames are held for at most ``delay`` seconds or until ``max_items`` are
+    buffered, then sent together as one array frame
+    """
+
+    def __init__(
+        self,
+        send: Callable[[Frame], Awaitable],
+        encode_batch: Callable[[list[Frame]], Frame],
+        delay: float,
+        max_items: int,
+    ):
+        super().__init__(delay, max_items)
+        self.send = send
+        self.encode_batch = encode_batch
+
+    def store(self, frame: Frame):
+        """
+        :param frame: encoded message
+        """
+        self.items.append(frame)
+
+    async def handle(self, items: list[Frame]):
+        await self.send(self.encode_batch(items))
@@ -0,0 +1,129 @@
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # redis comes with channels-redis, but keep the other registries usable without it
+    redis = None
+
+
+class MemoryPresenceRegistry:
+    """
+    connected devices per user, only correct when a single worker serves every socket
+
+    a device is online for ``ttl`` seconds after its last add(), consumers call
+    add() again every CHAT_PRESENCE_HEARTBEAT seconds while their socket is open
+    """
+
+    def __init__(self, ttl: float, clock=time.time):
+        self.ttl = ttl  # seconds
+        self.clock = clock
+        self.devices: defaultdict[int, dict[str, float]] = defaultdict(dict)  # expiry times
+
+    async def add(self, user_id: int, device: str):
+        self.devices[user_id][device] = self.clock() + self.ttl
+
+    async def remove(self, user_id: int, device: str):
+        devices = self.devices.get(user_id)
+        if devices is None:
+            return
+        devices.pop(device, None)
+        if not devices:
+            del self.devices[user_id]
+
+    async def online(self, user_ids) -> set[int]:
+        """
+        :param user_ids: user ids to check
+        :return: those with at least one connected device
+        """
+        now = self.clock()
+        return {
+            user_id
+            for user_id in user_ids
+            if any(expiry > now for expiry in self.devices.get(user_id, {}).values())
+        }
+
+
+class RedisPresenceRegistry:
+    """
+    same as MemoryPresenceRegistry but shared by every worker through redis
+
+    a user's devices are a sorted set scored by the expiry time of each device, so
+    a device of a crashed worker goes offline ``ttl`` seconds after its last
+    heartbeat while the user's other devices stay online; errors count as online
+    """
+
+    def __init__(self, host: str, port: int, ttl: int, clock=time.time):
+        self.host = host
+        self.port = port
+        self.ttl = ttl  # seconds
+        self.clock = clock
+        self.client = None
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f"presence:{user_id}"
+
+    def _client(self):
+        if self.client is None:
+            self.client = redis.Redis(host=self.host, port=self.port)
+        return self.client
+
+    async def add(self, user_id: int, device: str):
+        try:
+            now = self.clock()
+            async with self._client().pipeline(transaction=True) as pipe:
+                pipe.zadd(self._key(user_id), {device: now + self.ttl})
+                pipe.zremrangebyscore(self._key(user_id), "-inf", now)
+                pipe.expire(self._key(user_id), self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            print(f"presence registry unavailable: {str(e)}")
+
+    async def remove(self, user_id: int, device: str):
+        try:
+            await self._client().zrem(self._key(user_id), device)
+        except Exception as e:
+            print(f"presence registry unavailable: {str(e)}")
+
+    async def online(self, user_ids) -> set[int]:
+        user_ids = list(user_ids)
+        now = self.clock()
+        try:
+            async with self._client().pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.zcount(self._key(user_id), f"({now}", "+inf")
+                found = await pipe.execute()
+        except Exception as e:
+            print(f"presence registry unavailable: {str(e)}")
+            return set(user_ids)
+        return {user_id for user_id, exists in zip(user_ids, found) if exists}
+
+
+class NullPresenceRegistry:
+    """
+    presence tracking disabled, every user counts as online
+    """
+
+    async def add(self, user_id: int, device: str):
+        pass
+
+    async def remove(self, user_id: int, device: str):
+        pass
+
+    async def online(self, user_ids) -> set[int]:
+        return set(user_ids)
+
+
+def make_presence_registry():
+    if settings.CHAT_PRESENCE_BACKEND == "redis" and redis is not None:
+        host, port = settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"][0]
+        return RedisPresenceRegistry(host, port, settings.CHAT_PRESENCE_TTL)
+    if settings.CHAT_PRESENCE_BACKEND == "memory":
+        return MemoryPresenceRegistry(settings.CHAT_PRESENCE_TTL)
+    return NullPresenceRegistry()
+
+
+globalPresenceRegistry = make_presence_registry()
@@ -0,0 +1,304 @@
+import asyncio
+from collections import OrderedDict
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractRobustConnection
+from django.conf import settings
+
+from utils.db_fun import db_query_group_state
+
+
+class ExchangeCache:
+    """
+    bounded LRU cache of declared exchanges, keyed by exchange name
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.exchanges: OrderedDict[str, AbstractExchange] = OrderedDict()
+
+    def get(self, name: str) -> AbstractExchange | None:
+        exchange = self.exchanges.get(name)
+        if exchange is not None:
+            self.exchanges.move_to_end(name)
+        return exchange
+
+    def put(self, name: str, exchange: AbstractExchange):
+        self.exchanges[name] = exchange
+        self.exchanges.move_to_end(name)
+        while len(self.exchanges) > self.max_size:
+            self.exchanges.popitem(last=False)
+
+    def pop(self, name: str):
+        self.exchanges.pop(name, None)
+
+    def clear(self, *_):
+        self.exchanges.clear()
+
+    def __len__(self):
+        return len(self.exchanges)
+
+
+class PooledConnection:
+    def __init__(self, connection: AbstractRobustConnection, cache_size: int):
+        self.connection = connection
+        self.channels = 0
+        # one shared channel per connection is used for publishing, so declared
+        # exchanges can be reused by every consumer living on this connection
+        self.publish_channel: AbstractChannel | None = None
+        self.exchanges = ExchangeCache(cache_size)
+        # members ever bound to each group through this connection; robust exchanges
+        # replay their bindings on reconnect, even those removed since by other nodes
+        self.bound: dict[int, set[int]] = {}
+        self.lock = asyncio.Lock()
+        connection.reconnect_callbacks.add(self.exchanges.clear)
+
+    async def get_exchange(self, name: str, type: str = "fanout") -> AbstractExchange:
+        exchange = self.exchanges.get(name)
+        if exchange is not None:
+            return exchange
+        async with self.lock:
+            if self.publish_channel is None or self.publish_channel.is_closed:
+                self.exchanges.clear()
+                self.publish_channel = await self.connection.channel()
+                self.publish_channel.close_callbacks.add(self.exchanges.clear)
+        exchange = await self.publish_channel.declare_exchange(name, type=type)
+        self.exchanges.put(name, exchange)
+        return exchange
+
+    async def delete_exchange(self, name: str):
+        exchange = await self.get_exchange(name)
+        self.exchanges.pop(name)
+        await exchange.delete()
+
+
+def device_queue_arguments() -> dict:
+    """
+    arguments of the per-browser queues
+
+    unused queues expire, their length is capped and messages are kept on disk
+    """
+    return {
+        "x-expires": settings.RABBITMQ_QUEUE_EXPIRES * 1000,
+        "x-max-length": settings.RABBITMQ_QUEUE_MAX_LENGTH,
+        "x-queue-mode": "lazy",
+    }
+
+
+class RabbitMQPool:
+    """
+    process wide pool of robust RabbitMQ connections
+
+    every consumer borrows a channel from one of the pooled connections instead of
+    opening its own connection, so a worker keeps at most ``max_connections`` AMQP
+    connections no matter how many websockets it serves
+    """
+
+    def __init__(
+        self, url: str, max_connections: int, max_channels: int, cache_size: int
+    ):
+        self.url = url
+        self.max_connections = max_connections
+        self.max_channels = max_channels  # channels per connection
+        self.cache_size = cache_size  # declared exchanges cached per connection
+        self.connections: list[PooledConnection] = []
+        self.owners: dict[AbstractChannel, PooledConnection] = {}
+        # groups whose exchange bindings were fully synced by this process
+        self.groups: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()  # resyncs after reconnects
+        self.condition: asyncio.Condition | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    def _bind_loop(self):
+        # asyncio primitives (and the connections) belong to the loop that created them
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.condition = asyncio.Condition()
+            self.connections = []
+            self.owners = {}
+            self.groups = set()
+            self.tasks = set()
+
+    async def _pick_connection(self) -> PooledConnection:
+        # robust connections reconnect by themselves, only explicitly closed ones are dropped
+        self.connections = [c for c in self.connections if not c.connection.is_closed]
+        while True:
+            available = [c for c in self.connections if c.channels < self.max_channels]
+            if available:
+                return min(available, key=lambda c: c.channels)
+            if len(self.connections) < self.max_connections:
+                connection = await aio_pika.connect_robust(self.url)
+                pooled = PooledConnection(connection, self.cache_size)
+                connection.reconnect_callbacks.add(lambda *_: self._schedule_resync(pooled))
+                self.connections.append(pooled)
+                return pooled
+            # pool is full, wait for a channel to be released
+            await self.condition.wait()
+
+    async def acquire_channel(self) -> AbstractChannel:
+        """
+        borrow a channel from the pool
+
+        :return: a robust channel, restored automatically when its connection reconnects
+        """
+        self._bind_loop()
+        async with self.condition:
+            pooled = await self._pick_connection()
+            pooled.channels += 1
+        try:
+            channel = await pooled.connection.channel()
+        except Exception:
+            await self._release_slot(pooled)
+            raise
+        self.owners[channel] = pooled
+        return channel
+
+    async def release_channel(self, channel: AbstractChannel | None):
+        """
+        close a borrowed channel and give its slot back to the pool
+
+        :param channel: channel returned by acquire_channel
+        """
+        if channel is None:
+            return
+        pooled = self.owners.pop(channel, None)
+        try:
+            if not channel.is_closed:
+                await channel.close()
+        finally:
+            if pooled is not None:
+                await self._release_slot(pooled)
+
+    async def _release_slot(self, pooled: PooledConnection):
+        async with self.condition:
+            pooled.channels -= 1
+            self.condition.notify()
+
+    async def get_exchange(
+        self, channel: AbstractChannel, name: str, type: str = "fanout"
+    ) -> AbstractExchange:
+        """
+        get a declared exchange for publishing, declaring it only on cache miss
+
+        :param channel: channel borrowed by the caller, selects the connection to publish on
+        :param name: exchange name
+        :param type: exchange type
+        :return: exchange bound to the shared publish channel of that connection
+        """
+        pooled = self.owners.get(channel)
+        if pooled is None:
+            # channel not from the pool, fall back to a plain declare
+            return await channel.declare_exchange(name, type=type)
+        return await pooled.get_exchange(name, type)
+
+    def _schedule_resync(self, pooled: PooledConnection):
+        # replayed bindings may re-add removed members, bindings lost with a broker
+        # restart are replayed as well but members added meanwhile are not
+        self.groups.difference_update(pooled.bound)
+        task = asyncio.get_running_loop().create_task(self._resync(pooled))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _resync(self, pooled: PooledConnection):
+        for group_id in list(pooled.bound):
+            try:
+                db_query_group_state.forget(group_id)  # may predate the outage
+                await self._sync(pooled, group_id, rebind=True)
+                self.groups.add(group_id)
+            except Exception as e:
+                print(f"cannot resync bindings of group {group_id}: {str(e)}")
+
+    def _pooled(self, channel: AbstractChannel) -> PooledConnection:
+        pooled = self.owners.get(channel)
+        if pooled is None:
+            raise KeyError("channel is not borrowed from the pool")
+        return pooled
+
+    async def bind_group_members(
+        self, channel: AbstractChannel, group_id: int, members
+    ):
+        """
+        bind ``user_<id>`` exchanges of members to the ``group_<id>`` fanout exchange
+
+        :param channel: channel borrowed by the caller
+        :param group_id: group id
+        :param members: ids of members to bind
+        """
+        await self._bind(self._pooled(channel), group_id, members)
+
+    async def unbind_group_members(
+        self, channel: AbstractChannel, group_id: int, members
+    ):
+        await self._unbind(self._pooled(channel), group_id, members)
+
+    async def _bind(self, pooled: PooledConnection, group_id: int, members):
+        group_exchange = await pooled.get_exchange("group_" + str(group_id))
+        bound = pooled.bound.setdefault(group_id, set())
+        for member in members:
+            user_exchange = await pooled.get_exchange("user_" + str(member))
+            await user_exchange.bind(group_exchange)
+            bound.add(member)
+
+    async def _unbind(self, pooled: PooledConnection, group_id: int, members):
+        # members stay in pooled.bound, an older exchange object may still replay them
+        group_exchange = await pooled.get_exchange("group_" + str(group_id))
+        for member in members:
+            user_exchange = await pooled.get_exchange("user_" + str(member))
+            await user_exchange.unbind(group_exchange)
+
+    async def sync_group(self, channel: AbstractChannel, group_id: int, min_version: int = 0):
+        """
+        make sure the group exchange exists and exactly its members are bound to it
+
+        membership is loaded from the database, not taken from the caller, so a
+        stale contact list cannot bind removed members again. only the first call
+        per group in this process (and the resync after a reconnect) talks to the
+        broker, later changes are applied incrementally by bind/unbind_group_members
+
+        :param channel: channel borrowed by the caller
+        :param group_id: group id
+        :param min_version: version of the group known to the caller
+        """
+        if group_id in self.groups:
+            return
+        await self._sync(self._pooled(channel), group_id, min_version)
+        self.groups.add(group_id)
+
+    async def _sync(
+        self, pooled: PooledConnection, group_id: int, min_version: int = 0, rebind=False
+    ):
+        state = await db_query_group_state(group_id)
+        if state is not None and state[4] < min_version:
+            db_query_group_state.forget(group_id)
+            state = await db_query_group_state(group_id)
+        members = state[0] if state is not None else frozenset()
+        known = set()
+        if not rebind:
+            known = known.union(*(p.bound.get(group_id, ()) for p in self.connections))
+        await self._bind(pooled, group_id, members - known)
+        for p in self.connections:
+            stale = p.bound.get(group_id, set()) - members
+            if stale:
+                await self._unbind(p, group_id, stale)
+
+    async def delete_group(self, channel: AbstractChannel, group_id: int):
+        pooled = self._pooled(channel)
+        self.groups.discard(group_id)
+        for p in self.connections:
+            p.bound.pop(group_id, None)
+        await pooled.delete_exchange("group_" + str(group_id))
+
+    async def close(self):
+        for pooled in self.connections:
+            await pooled.connection.close()
+        self.connections = []
+        self.owners = {}
+
+
+globalRabbitMQPool = RabbitMQPool(
+    settings.RABBITMQ_URL,
+    settings.RABBITMQ_POOL_SIZE,
+    settings.RABBITMQ_CHANNELS_PER_CONNECTION,
+    settings.RABBITMQ_EXCHANGE_CACHE_SIZE,
+)
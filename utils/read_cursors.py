@@ -0,0 +1,143 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from users.models import Friendship, GroupList, MessageList, ReadCursor
+from utils.data import MessageType, TargetType
+
+
+def conversation_of(message: MessageList, user_id: int) -> tuple[int, int]:
+    """
+    :param message: a stored message
+    :param user_id: user reading it
+    :return: (t_type, target) of the conversation the message belongs to for this user
+    """
+    if message.t_type == TargetType.GROUP:
+        return TargetType.GROUP, message.receiver
+    if message.receiver == user_id:
+        return TargetType.FRIEND, message.sender
+    return TargetType.FRIEND, message.receiver
+
+
+def advance_read_cursors(user_id: int, marks: dict[tuple[int, int], int]):
+    """
+    move read watermarks of a user forward, a cursor never moves back
+
+    :param user_id: reader
+    :param marks: highest read message id by (t_type, target)
+    """
+    if not marks:
+        return
+    targets = Q()
+    whens = []
+    for (t_type, target), message_id in marks.items():
+        condition = Q(t_type=t_type, target=target)
+        targets |= condition
+        whens.append(When(condition, then=Value(message_id)))
+    with transaction.atomic():
+        ReadCursor.objects.bulk_create(
+            [
+                ReadCursor(user_id=user_id, t_type=t_type, target=target)
+                for t_type, target in marks
+            ],
+            ignore_conflicts=True,
+        )
+        ReadCursor.objects.filter(targets, user_id=user_id).update(
+            last_read=Greatest("last_read", Case(*whens, default=F("last_read")))
+        )
+
+
+def read_by(messages) -> dict[int, list[int]]:
+    """
+    derive who read each message from the read cursors, with at most two queries
+
+    a friend message is read by its receiver, a group message by every member but
+    the sender whose cursor reached it
+
+    :param messages: stored messages
+    :return: ids of the readers by message id
+    """
+    groups = {m.receiver for m in messages if m.t_type == TargetType.GROUP}
+    peers = {
+        user_id
+        for m in messages
+        if m.t_type != TargetType.GROUP
+        for user_id in (m.sender, m.receiver)
+    }
+    group_cursors: defaultdict[int, list[tuple[int, int]]] = defaultdict(list)
+    friend_cursors: dict[tuple[int, int], int] = {}
+    if groups:
+        for target, user_id, last_read in ReadCursor.objects.filter(
+            t_type=TargetType.GROUP, target__in=groups
+        ).values_list("target", "user_id", "last_read"):
+            group_cursors[target].append((user_id, last_read))
+    if peers:
+        for target, user_id, last_read in ReadCursor.objects.filter(
+            t_type=TargetType.FRIEND, user_id__in=peers, target__in=peers
+        ).values_list("target", "user_id", "last_read"):
+            friend_cursors[(user_id, target)] = last_read
+    readers = {}
+    for m in messages:
+        if m.t_type == TargetType.GROUP:
+            readers[m.message_id] = [
+                user_id
+                for user_id, last_read in group_cursors[m.receiver]
+                if last_read >= m.message_id and user_id != m.sender
+            ]
+        else:
+            last_read = friend_cursors.get((m.receiver, m.sender), 0)
+            readers[m.message_id] = [m.receiver] if last_read >= m.message_id else []
+    return readers
+
+
+def unread_counts(user_id: int) -> dict[str, dict[int, int]]:
+    """
+    count messages newer than the read cursors in every conversation of a user
+
+    :param user_id: reader
+    :return: {"friends": {friend id: count}, "groups": {group id: count}}, only
+        conversations with unread messages are listed
+    """
+
+    def cursor(t_type: int, target: str):
+        # the last message read in the conversation of each counted message
+        return Coalesce(
+            Subquery(
+                ReadCursor.objects.filter(
+                    user_id=user_id, t_type=t_type, target=OuterRef(target)
+                ).values("last_read")[:1]
+            ),
+            0,
+        )
+
+    group_ids = GroupList.objects.filter(group_members=user_id).values("group_id")
+    friend_ids = Q(
+        sender__in=Friendship.objects.filter(user2=user_id, state=1).values("user1")
+    ) | Q(sender__in=Friendship.objects.filter(user1=user_id, state=1).values("user2"))
+    messages = MessageList.objects.filter(m_type__lt=MessageType.FUNCTION).exclude(
+        deleted_users=user_id
+    )
+    return {
+        "friends": dict(
+            messages.filter(
+                friend_ids,
+                t_type=TargetType.FRIEND,
+                receiver=user_id,
+                message_id__gt=cursor(TargetType.FRIEND, "sender"),
+            )
+            .values_list("sender")
+            .annotate(Count("message_id"))
+        ),
+        "groups": dict(
+            messages.filter(
+                t_type=TargetType.GROUP,
+                receiver__in=group_ids,
+                message_id__gt=cursor(TargetType.GROUP, "receiver"),
+            )
+            .exclude(sender=user_id)
+            .values_list("receiver")
+            .annotate(Count("message_id"))
+        ),
+    }
@@ -0,0 +1,45 @@
+from typing import Awaitable, Callable
+
+from utils.data import Message
+from utils.debounce import DebouncedBuffer
+
+
+class ReadReceiptBuffer(DebouncedBuffer):
+    """
+    collects the read events of one socket
+
+    events are held for at most ``delay`` seconds or until ``max_items`` distinct
+    messages were read, then handed over together, so scrolling through a
+    conversation costs one cursor update and one receipt per conversation
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[dict[int, Message]], Awaitable],
+        delay: float,
+        max_items: int,
+    ):
+        """
+        :param flush: receives the read events by message id
+        :param delay: seconds an event may wait for others
+        :param max_items: events handed over at once
+        """
+        super().__init__(delay, max_items)
+        self.on_flush = flush
+
+    def new_items(self) -> dict[int, Message]:
+        return {}
+
+    def store(self, message_id: int, message: Message):
+        """
+        :param message_id: id of the message that was read
+        :param message: the FUNC_READ_MESSAGE event
+        """
+        self.items[message_id] = message
+
+    async def handle(self, items: dict[int, Message]):
+        try:
+            await self.on_flush(items)
+        except Exception as e:
+            # also raised by a flush on close or on a full buffer, keep the socket up
+            print(f"cannot handle {len(items)} read events: {str(e)}")
@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls with the same key into one
+
+    callers arriving while a call is in flight wait for it and share its result;
+    with a ttl the result is also kept for that many seconds. failures are shared
+    by the waiting callers but never kept. results are shared, so callers must
+    not mutate them
+    """
+
+    def __init__(self, ttl: float = 0, max_size: int = 4096):
+        self.ttl = ttl  # seconds
+        self.max_size = max_size
+        # futures belong to a loop, tests and management commands may run several
+        self.calls: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Hashable, asyncio.Task]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.results: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self.shared = 0  # calls answered by another call or by a kept result
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+        """
+        :param key: identifies the call
+        :param func: makes the call when nothing can be shared
+        :return: result of the call
+        """
+        if self.ttl > 0:
+            entry = self.results.get(key)
+            if entry is not None:
+                if entry[1] >= time.monotonic():
+                    self.shared += 1
+                    return entry[0]
+                del self.results[key]
+        loop = asyncio.get_running_loop()
+        calls = self.calls.setdefault(loop, {})
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(self._run(calls, key, func))
+        else:
+            self.shared += 1
+        # a cancelled caller must not cancel the call the others are waiting for
+        return await asyncio.shield(task)
+
+    async def _run(self, calls: dict, key: Hashable, func: Callable[[], Awaitable]):
+        try:
+            result = await func()
+        finally:
+            del calls[key]
+        if self.ttl > 0:
+            self.results[key] = (result, time.monotonic() + self.ttl)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+        return result
+
+    def forget(self, key: Hashable):
+        """
+        drop the kept result of a key, an in-flight call is not affected
+        """
+        self.results.pop(key, None)
+
+
+def singleflight(ttl: float = 0):
+    """
+    coalesce concurrent calls of an async function with equal arguments
+
+    calls with unhashable arguments are not coalesced
+
+    :param ttl: seconds to keep results for, 0 to only share in-flight calls
+    """
+
+    def decorator(func: Callable[..., Awaitable]):
+        flight = SingleFlight(ttl)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return await func(*args, **kwargs)
+            return await flight.do(key, lambda: func(*args, **kwargs))
+
+        def forget(*args, **kwargs):
+            flight.forget((args, tuple(sorted(kwargs.items()))))
+
+        wrapper.flight = flight
+        wrapper.forget = forget
+        return wrapper
+
+    return decorator
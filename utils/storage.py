@@ -1,52 +1,280 @@
+import asyncio
 import json
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import pika
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractIncomingMessage
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, close_old_connections, transaction
 
 from users.models import MessageList
-from utils.data import Message, ContactsData
+from utils.codec import decode_body
+from utils.data import ContactsData, Message
 
+STORAGE_QUEUE = "PermStore"
+DEAD_EXCHANGE = "PermStore.dead"  # deliveries that could not be stored
+DEAD_QUEUE = "PermStore.dead"  # bound to DEAD_EXCHANGE, kept until replayed
 
-def storage_callback(ch, method, properties, body):
-    print("storing")
+
+def message_to_row(message: Message) -> MessageList:
+    return MessageList(
+        message_id=message.message_id,
+        m_type=message.m_type,
+        t_type=message.t_type,
+        time=message.time,
+        content=json.dumps(
+            message.content
+            if not isinstance(message.content, ContactsData)
+            else message.content.model_dump()
+        ),
+        sender=message.sender,
+        receiver=message.receiver,
+        info=json.dumps(message.info),
+    )
+
+
+def same_message(row: MessageList, stored: MessageList) -> bool:
+    # a redelivery, not a message id given out again after a restart
+    return (row.sender, row.receiver, row.time) == (stored.sender, stored.receiver, stored.time)
+
+
+def conflict_error(row: MessageList) -> Exception:
+    return IntegrityError(f"message id {row.message_id} is already used by another message")
+
+
+def retry_locked(func):
+    """
+    run func until the database is not locked by another writer anymore
+
+    a locked database (sqlite allows a single writer) is not a problem of the
+    messages, so they are not dead lettered; the batch stays unacknowledged meanwhile
+    """
+    delay = 0.05
+    while True:
+        try:
+            return func()
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            print(f"database is locked, retrying in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 2)
+
+
+def write_batch(rows: list[MessageList]) -> dict[int, Exception]:
+    with transaction.atomic():
+        stored = MessageList.objects.only(
+            "message_id", "sender", "receiver", "time"
+        ).in_bulk([row.message_id for row in rows])
+        errors = {
+            index: conflict_error(row)
+            for index, row in enumerate(rows)
+            if row.message_id in stored and not same_message(row, stored[row.message_id])
+        }
+        MessageList.objects.bulk_create([row for row in rows if row.message_id not in stored])
+    return errors
+
+
+def write_row(row: MessageList):
+    with transaction.atomic():
+        row.save(force_insert=True)
+
+
+def write_rows(rows: list[MessageList]) -> dict[int, Exception]:
+    """
+    store rows in one transaction, one transaction per row if that fails
+
+    a row whose message id is stored already is skipped if the stored message has
+    the same sender, receiver and time, so a redelivered message is stored once and
+    never overwrites later changes (withdrawal, edits, ...). any other conflict is
+    an error, the row is not silently dropped
+
+    :param rows: rows to insert
+    :return: errors of the rows that could not be stored, by index
+    """
+    close_old_connections()
     try:
-        message = Message.model_validate_json(body.decode())
-        # 将接收到的信息放入数据库
-        mes = MessageList(
-            message_id=message.message_id,
-            m_type=message.m_type,
-            t_type=message.t_type,
-            time=message.time,
-            content=json.dumps(
-                message.content
-                if not isinstance(message.content, ContactsData)
-                else message.content.model_dump()
-            ),
-            sender=message.sender,
-            receiver=message.receiver,
-            info=json.dumps(message.info),
-        )
-        mes.save()
+        return retry_locked(lambda: write_batch(rows))
     except Exception as e:
-        print(e)
-        ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
-    else:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        print("stored")
+        print(f"batch of {len(rows)} failed ({str(e)}), storing one by one")
+    errors = {}
+    for index, row in enumerate(rows):
+        try:
+            retry_locked(lambda: write_row(row))
+        except IntegrityError as e:
+            stored = MessageList.objects.filter(message_id=row.message_id).first()
+            if stored is None:
+                errors[index] = e
+            elif not same_message(row, stored):
+                errors[index] = conflict_error(row)
+        except Exception as e:
+            errors[index] = e
+    return errors
 
 
-def start_storage():
-    while True:
+class StoragePipeline:
+    """
+    stores PermStore deliveries in three asyncio stages: consume, decode and write
+
+    stages are connected by bounded queues, so a slow database stops consumption
+    instead of buffering deliveries. batches of up to ``batch_size`` rows, or what
+    arrived within ``interval`` seconds, are written on one dedicated database thread
+    and acknowledged with one cumulative ack. a delivery that cannot be decoded or
+    stored is published to the dead letter exchange, confirmed by the broker before
+    the ack; ``manage.py replay_dead_letters`` sends them through the pipeline again
+    """
+
+    def __init__(
+        self, batch_size: int, interval: float, report_interval: float = 0, write=None
+    ):
+        """
+        :param batch_size: rows written per transaction
+        :param interval: seconds a partial batch may wait
+        :param report_interval: seconds between throughput reports, 0 to never report
+        :param write: coroutine function storing rows like write_rows, defaults to
+            write_rows on the database thread
+        """
+        self.batch_size = batch_size
+        self.interval = interval
+        self.report_interval = report_interval
+        self.write = write or self._write
+        self.received: asyncio.Queue[AbstractIncomingMessage] = asyncio.Queue(batch_size * 2)
+        self.decoded: asyncio.Queue[tuple[AbstractIncomingMessage, MessageList | None]] = (
+            asyncio.Queue(batch_size * 2)
+        )
+        self.stopping = asyncio.Event()
+        self.channel: AbstractChannel | None = None
+        self.dead_exchange: AbstractExchange | None = None
+        self.executor: ThreadPoolExecutor | None = None
+        self.stored = 0  # messages written so far
+
+    async def _write(self, rows: list[MessageList]) -> dict[int, Exception]:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-db")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, write_rows, rows)
+
+    async def connect(self):
+        # a robust connection reconnects by itself, but only once it was established
+        while not self.stopping.is_set():
+            try:
+                return await aio_pika.connect_robust(settings.RABBITMQ_URL)
+            except (OSError, aio_pika.exceptions.AMQPConnectionError):
+                print("storage connection failed, retrying...")
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+        return None
+
+    async def run(self):
+        """
+        consume until stop() is called, then store what was received and return
+        """
+        connection = await self.connect()
+        if connection is None:
+            return
+        stages = []
         try:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host="localhost")
+            self.channel = await connection.channel(publisher_confirms=True)
+            # deliveries of a whole batch are unacknowledged until it is written
+            await self.channel.set_qos(prefetch_count=self.batch_size * 2)
+            queue = await self.channel.declare_queue(STORAGE_QUEUE)
+            self.dead_exchange = await self.channel.declare_exchange(DEAD_EXCHANGE, type="fanout")
+            dead_queue = await self.channel.declare_queue(DEAD_QUEUE)
+            await dead_queue.bind(self.dead_exchange)
+            stages = [
+                asyncio.create_task(self.decode_stage()),
+                asyncio.create_task(self.write_stage()),
+            ]
+            if self.report_interval > 0:
+                stages.append(asyncio.create_task(self.report_stage()))
+            consumer_tag = await queue.consume(self.received.put)
+            print("storage consumption start")
+            stopping = asyncio.create_task(self.stopping.wait())
+            await asyncio.wait([stopping, *stages], return_when=asyncio.FIRST_COMPLETED)
+            for stage in stages:
+                if stage.done():
+                    stopping.cancel()
+                    stage.result()  # a stage failed, let the worker be restarted
+            await queue.cancel(consumer_tag)
+            await self.received.join()
+            await self.decoded.join()
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await connection.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        print("storage consumption stopped")
+
+    def stop(self):
+        self.stopping.set()
+
+    async def decode_stage(self):
+        while True:
+            incoming = await self.received.get()
+            try:
+                row = message_to_row(decode_body(incoming.body, incoming.content_type))
+            except Exception as e:
+                await self.dead_letter(incoming, e)
+                row = None
+            # dead lettered deliveries are passed on to be acknowledged in order
+            await self.decoded.put((incoming, row))
+            self.received.task_done()
+
+    async def write_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.decoded.get()]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.decoded.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+            for _ in batch:
+                self.decoded.task_done()
+
+    async def flush(self, batch: list[tuple[AbstractIncomingMessage, MessageList | None]]):
+        rows = [(incoming, row) for incoming, row in batch if row is not None]
+        if rows:
+            errors = await self.write([row for _, row in rows])
+            for index, error in errors.items():
+                await self.dead_letter(rows[index][0], error)
+            self.stored += len(rows) - len(errors)
+        try:
+            # deliveries arrive in order, the last ack covers the whole batch
+            await batch[-1][0].ack(multiple=True)
+        except Exception as e:
+            # the channel was reopened meanwhile, the broker redelivers these
+            print(f"cannot acknowledge batch: {str(e)}")
+
+    async def dead_letter(self, incoming: AbstractIncomingMessage, error: Exception):
+        print(f"cannot store message: {str(error)}")
+        await self.dead_exchange.publish(
+            aio_pika.Message(
+                body=incoming.body,
+                content_type=incoming.content_type,
+                headers={"x-error": str(error)[:255]},
+            ),
+            routing_key="",
+        )
+
+    async def report_stage(self):
+        loop = asyncio.get_running_loop()
+        last_stored, last_time = self.stored, loop.time()
+        while True:
+            await asyncio.sleep(self.report_interval)
+            now = loop.time()
+            print(
+                f"storage worker {os.getpid()}: "
+                f"{(self.stored - last_stored) / (now - last_time):.1f} messages/s, "
+                f"{self.stored} stored"
             )
-            break
-        except pika.exceptions.AMQPConnectionError:
-            print("storage connection failed, retrying...")
-            time.sleep(1)
-    channel = connection.channel()
-    channel.queue_declare(queue="PermStore")
-    channel.basic_consume(queue="PermStore", on_message_callback=storage_callback)
-    print("storage consumption start")
-    channel.start_consuming()
+            last_stored, last_time = self.stored, now